@@ -0,0 +1,270 @@
+"""
+Benchmarks of the main TTnet processing paths.
+
+    - model_scalar:    scalar evaluations of the TTnet model
+    - model_batched:   vectorized evaluations of the TTnet model
+    - parse_series:    parse_test_series on synthetic raw data
+    - load_processed:  loading of the shipped `data_processed` series (CSV)
+    - compute_KPIs:    compute_KPIs end to end (requires triscale)
+    - imports:         import time of the main modules, in fresh interpreters
+
+Each benchmark reports its best wall-clock time over `--repeat` runs, the
+corresponding throughput, and the peak memory allocated by Python in the
+main process (tracemalloc, measured in a separate run). Results are saved
+as JSON; pass a previous result file to `--compare` to print the speedup
+of each benchmark. Only generated data and the shipped processed data are
+used. Benchmarks whose dependencies are missing are reported as skipped.
+
+Usage (from the repository root):
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --compare bench.json --only parse_series
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+repo_folder = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repo_folder))
+
+from src.ttnet_model import compute_T_round, compute_energy_saving
+from src.ttnet_synthetic import generate_series, default_failure_rates
+
+# ==============================================================================
+class SkipBenchmark(Exception):
+    '''
+    Raised by a benchmark that cannot run in the current environment.
+    '''
+
+# ==============================================================================
+def bench_model_scalar(args):
+    Hs = range(1, 9)
+    Ns = range(1, 5)
+    Ls = range(8, 72, 8)
+    Bs = range(1, 31)
+    def run():
+        for H in Hs:
+            for N in Ns:
+                for L in Ls:
+                    for B in Bs:
+                        compute_T_round(H,N,L,B)
+                        compute_energy_saving(H,N,L,B)
+    return run, len(Hs)*len(Ns)*len(Ls)*len(Bs), 'configurations'
+
+def bench_model_batched(args):
+    rng = np.random.default_rng(0)
+    n = args.configurations
+    H = rng.integers(1, 9, n)
+    N = rng.integers(1, 5, n)
+    L = rng.integers(8, 65, n)
+    B = rng.integers(1, 31, n)
+    def run():
+        compute_T_round(H,N,L,B)
+        compute_energy_saving(H,N,L,B)
+    return run, n, 'configurations'
+
+def bench_parse_series(args):
+    try:
+        from src.ttnet_analysis import parse_test_series
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+    tmp_folder = Path(args.tmp_folder)
+    node_list = list(range(1, args.nodes + 1))
+    serie_folder = tmp_folder / "data_raw" / "serieB"
+    generate_series(serie_folder, node_list, args.tests,
+                    failure_rates=default_failure_rates)
+    log_size = sum(path.stat().st_size for path in serie_folder.glob('results/*/serial.csv'))
+    series = {'label' : 'serieB', 'node_list' : node_list}
+    def run():
+        parse_test_series(series,
+                          tmp_folder / "data_raw",
+                          tmp_folder / "data_processed",
+                          force_computation=True,
+                          plot=False,
+                          workers=args.workers,
+                          cache=False)
+    return run, args.tests, 'tests', {'log_MB' : log_size/1e6}
+
+def bench_load_processed(args):
+    try:
+        from src.ttnet_analysis import parse_test_series, serie_1, serie_2, serie_3
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+    def run():
+        for series in [serie_1, serie_2, serie_3]:
+            parse_test_series(series,
+                              repo_folder / "data_raw",
+                              repo_folder / "data_processed",
+                              plot=False,
+                              cache=False)
+    n_rows = sum(len(pd.read_csv(str(path), usecols=[0])) for path in
+                 (repo_folder / "data_processed").glob('serie*/serie*_all.csv'))
+    return run, n_rows, 'rows'
+
+def bench_compute_KPIs(args):
+    try:
+        import triscale
+        from src.ttnet_analysis import compute_KPIs, clear_series_cache
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+    KPI_energy = {'name': 'Energy savings', 'unit': '\\%', 'percentile': 5, 'confidence': 95,
+                  'class': 'one-sided', 'bounds': [0,100], 'bound': 'lower'}
+    KPI_round  = {'name': 'Length of a round', 'unit': '\\%', 'percentile': 95, 'confidence': 95,
+                  'class': 'one-sided', 'bounds': [0,100], 'bound': 'upper'}
+    Bs = [5, 10, 30]
+    Ls = [8, 16, 64]
+    def run():
+        # Load the processed series in every run, as in a fresh session
+        clear_series_cache()
+        compute_KPIs(KPI_energy, KPI_round, Bs, Ls, 4, 2,
+                     memo_file=None, workers=args.workers)
+    return run, 3*len(Bs)*len(Ls), 'KPIs'
+
+# Modules whose import time is measured
+import_modules = ['src.ttnet_model',
+                  'src.ttnet_logs',
+                  'src.ttnet_analysis']
+
+def bench_imports(args):
+    result = {'import_ms' : {}}
+    def run():
+        for module in import_modules:
+            # Cumulative import time of the module, reported by -X importtime
+            output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                                    cwd=str(repo_folder), stderr=subprocess.PIPE,
+                                    check=True).stderr.decode()
+            for line in output.splitlines():
+                fields = line.split('|')
+                if len(fields) == 3 and fields[2].strip() == module:
+                    result['import_ms'][module] = int(fields[1]) / 1000
+    return run, len(import_modules), 'modules', result
+
+benchmarks = {'model_scalar'   : bench_model_scalar,
+              'model_batched'  : bench_model_batched,
+              'parse_series'   : bench_parse_series,
+              'load_processed' : bench_load_processed,
+              'compute_KPIs'   : bench_compute_KPIs,
+              'imports'        : bench_imports}
+
+# ==============================================================================
+def run_benchmark(name, args):
+    '''
+    Time a benchmark and measure its peak memory.
+    '''
+    setup = benchmarks[name](args)
+    run, n_items, unit = setup[:3]
+    result = setup[3] if len(setup) > 3 else {}
+
+    # Discard the progress messages of the benchmarked functions
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        times = []
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result.update({'items'          : n_items,
+                   'unit'           : unit,
+                   'times_s'        : times,
+                   'best_s'         : min(times),
+                   'throughput'     : n_items / min(times),
+                   'peak_memory_MB' : peak_memory / 1e6})
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=str(repo_folder),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, reference=None):
+    for name, result in results.items():
+        if 'skipped' in result:
+            print('%-16s skipped (%s)' % (name, result['skipped']))
+            continue
+        line = ('%-16s %10.4f s  %12.1f %s/s  %8.1f MB'
+                % (name, result['best_s'], result['throughput'],
+                   result['unit'], result['peak_memory_MB']))
+        if reference is not None and 'best_s' in reference.get(name, {}):
+            line += '  x%.2f' % (reference[name]['best_s'] / result['best_s'])
+        print(line)
+
+# ==============================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the TTnet processing paths.')
+    parser.add_argument('--only', default=','.join(benchmarks),
+                        help='comma-separated benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs per benchmark')
+    parser.add_argument('--tests', type=int, default=200,
+                        help='number of synthetic tests (parse_series)')
+    parser.add_argument('--nodes', type=int, default=26,
+                        help='number of nodes per synthetic test (parse_series)')
+    parser.add_argument('--configurations', type=int, default=10**6,
+                        help='number of configurations (model_batched)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes (parse_series, compute_KPIs)')
+    parser.add_argument('--output', default=None,
+                        help='JSON file where the results are saved')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of a previous run, to compare with')
+    args = parser.parse_args()
+
+    # The analysis functions use paths relative to the repository
+    os.chdir(str(repo_folder))
+    args.tmp_folder = tempfile.mkdtemp(prefix='ttnet_bench_')
+
+    results = {}
+    try:
+        for name in args.only.split(','):
+            if name not in benchmarks:
+                parser.error('Unknown benchmark: %s' % name)
+            try:
+                results[name] = run_benchmark(name, args)
+            except SkipBenchmark as e:
+                results[name] = {'skipped' : str(e)}
+    finally:
+        shutil.rmtree(args.tmp_folder)
+
+    reference = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            reference = json.load(f)['results']
+    print_results(results, reference)
+
+    if args.output is not None:
+        parameters = {key: value for key, value in vars(args).items()
+                      if key not in ['output', 'compare', 'tmp_folder']}
+        report = {'commit'     : git_commit(),
+                  'date'       : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python'     : platform.python_version(),
+                  'numpy'      : np.__version__,
+                  'pandas'     : pd.__version__,
+                  'platform'   : platform.platform(),
+                  'parameters' : parameters,
+                  'results'    : results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+"""
+Makes the `src` modules importable when the tests are run with `pytest`.
+"""
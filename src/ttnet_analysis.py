@@ -1,21 +1,34 @@
 """
 Analysis functions related to the Time-Triggered Wireless project.
 
+The plotting modules (plotly) and triscale are only imported when a plot is
+drawn or a KPI is computed, such that parsing the test series does not
+require them.
+
 @author: Romain Jacob
 @date: 10.04.2020
 """
 
+import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
 
-import src.colors as colors
 from src.ttnet_model import *
-from src.ttnet_plots import *
-import triscale
+from src.ttnet_logs import (Discard, discard_messages, extract_events, concat_events,
+                            scan_events, write_node_logs)
+from src.ttnet_storage import (processed_file, typed_frame, write_processed, read_processed,
+                               import_csv, index_configurations, configuration_rows,
+                               SeriesBuffer)
+from src.ttnet_memo import KPIMemo, kpi_key
+from src.ttnet_raw import RawSeries
+from src.ttnet_profiling import PipelineStats, stage
 
 # Series list
 serie_1 = {'label' : 'serie1',
@@ -31,6 +44,13 @@ serie_3 = {'label' : 'serie3',
 linewidth_pt = 384
 linewidth_px = 512 # https://www.ninjaunits.com/converters/pixels/points-pixels/
 
+# KPI memos, by memo file
+kpi_memos = {}
+
+# In-memory cache of the processed series loaded by parse_test_series
+# (series, storage, columns, folder) -> (files fingerprint, df_all, df_metric)
+series_cache = {}
+
 # ==============================================================================
 def compute_KPIs(
     KPI_energy,
@@ -40,44 +60,106 @@ def compute_KPIs(
     H,
     N,
     to_plot=[],
-    verbose=False
+    verbose=False,
+    storage='csv',
+    memo_file=Path('.cache') / 'kpi_memo.json',
+    memo_size=4096,
+    workers=1,
+    stats=None,
+    profile=DPP2_CC430
 ):
+    '''
+    Compute the energy savings and round length KPIs of the three series,
+    for all (L,B) configurations.
+
+    memo_file: file where the KPI results are memoized (see src.ttnet_memo);
+               only the KPIs whose data or definition changed are recomputed.
+               None disables the memoization. Ignored when plotting (`to_plot`).
+    memo_size: maximal number of KPI results kept in the memo.
+    workers:   number of processes used to compute the KPIs in parallel;
+               1 computes them serially in the current process. Ignored when
+               plotting (`to_plot`).
+    stats:     optional PipelineStats collecting the stage timings and
+               counters (see src.ttnet_profiling).
+    profile:   parameters of the TTnet model values reported with the KPIs
+               (see src.ttnet_model.ModelProfile).
+    '''
 
     # Result storage
     KPI_energy_values = []
     KPI_round_values  = []
 
+    # KPI memo
+    memo = None
+    if memo_file is not None and not to_plot:
+        memo = get_kpi_memo(memo_file, memo_size)
+
     # Computing TTnet model values
     columns = [
         'L',
         'B',
         'round_model',
         'energy_model',]
-    tmp = []
-    for L in Ls:
-        for B in Bs:
-            tmp.append([
-                L,
-                B,
-                compute_T_round(H,N,L,B),
-                round(100*compute_energy_saving(H,N,L,B))
-            ])
-    df_summary = pd.DataFrame(tmp, columns=columns)
+    L_grid, B_grid = np.meshgrid(Ls, Bs, indexing='ij')
+    L_grid = L_grid.ravel()
+    B_grid = B_grid.ravel()
+    df_summary = pd.DataFrame({
+        'L':L_grid,
+        'B':B_grid,
+        'round_model':compute_T_round(H,N,L_grid,B_grid,profile),
+        'energy_model':np.round(100*compute_energy_saving(H,N,L_grid,B_grid,profile)).astype(int)
+    }, columns=columns)
 
     raw_data_folder = Path('data_raw')
     out_data_folder = Path('data_processed')
+
+    # Collect the data samples of all (series, L, B) configurations
+    series_samples = []
     for serie_id in [serie_1, serie_2, serie_3]:
 
         # Retrieve data for a series
         df_all, df = parse_test_series(serie_id,
                                        raw_data_folder,
                                        out_data_folder,
-                                       plot=False
+                                       plot=False,
+                                       storage=storage,
+                                       columns=['B_n_slots',
+                                                'L_payload_size',
+                                                'H',
+                                                'N',
+                                                'T_round',
+                                                'energy_savings'],
+                                       stats=stats
                                       )
 
+        # Index the samples of each (H,N,L,B) configuration, in one pass
+        with stage(stats, 'samples'):
+            df = df.dropna()
+            config_index = index_configurations(df)
+
+            samples = []
+            for L in Ls:
+                for B in Bs:
+                    # Extract the data corresponding to a given (B,L,H,N) set
+                    x = configuration_rows(df, config_index, H, N, L, B)
+                    samples.append((x.energy_savings.values, x.T_round.values))
+            series_samples.append(samples)
+
+    # Compute all the KPIs (energy and round length for each configuration)
+    jobs = []
+    for samples in series_samples:
+        for nrg_data, rd_data in samples:
+            jobs.append((nrg_data, KPI_energy))
+            jobs.append((rd_data, KPI_round))
+    with stage(stats, 'triscale'):
+        results = iter(evaluate_kpis(jobs, to_plot, verbose, memo, workers, stats))
+
+    for serie_id, samples in zip([serie_1, serie_2, serie_3], series_samples):
+
         # Temporary data storage
         tmp_nrg_column = []
         tmp_rd_column  = []
+        samples = iter(samples)
 
         for L in Ls:
 
@@ -91,15 +173,11 @@ def compute_KPIs(
 
             for B in Bs:
 
-                # Extract the data corresponding to a given (B,L,H,N) set
-                x = (df.loc[(df['B_n_slots']==B) &
-                            (df['L_payload_size']==L) &
-                            (df['H']==H) &
-                            (df['N']==N)]).dropna()
+                nrg_data, rd_data = next(samples)
 
-                # Compute the energy KPI
-                data = x.energy_savings.values
-                test, KPI_value = triscale.analysis_kpi(data, KPI_energy, to_plot, verbose=verbose)
+                # Energy KPI
+                data = nrg_data
+                test, KPI_value = next(results)
 
                 # Store intermediate results
                 tmp_nrg.append(KPI_value)
@@ -111,9 +189,9 @@ def compute_KPIs(
                 else:
                     tmp_nrg_column.append(round(KPI_value))
 
-                # Compute the round length KPI
-                data = x.T_round.values
-                test, KPI_value = triscale.analysis_kpi(data, KPI_round, to_plot, verbose=verbose)
+                # Round length KPI
+                data = rd_data
+                test, KPI_value = next(results)
 
                 # Store intermediate results
                 tmp_rd.append(KPI_value/1000)
@@ -148,6 +226,10 @@ def compute_KPIs(
         df_summary[ 'energy_' + serie_id['label'] ] = tmp_nrg_column
         df_summary[ 'round_' + serie_id['label'] ]  = tmp_rd_column
 
+    if memo is not None:
+        with stage(stats, 'memo_save'):
+            memo.save()
+
     # Set payload and number of slots as indexes
     df_summary.set_index(['L','B'], inplace=True)
 
@@ -165,7 +247,7 @@ def compute_KPIs(
             print(series['data']['test'])
             print(series['data']['KPI'])
             print(series['data']['max'])
-            print([compute_T_round(4,2,series['L'],b) for b in [5,10,30]])
+            print([compute_T_round(H,N,series['L'],b,profile) for b in series['data']['B']])
             print()
 
         print('Energy savings')
@@ -175,12 +257,78 @@ def compute_KPIs(
             print(series['data']['test'])
             print(series['data']['KPI'])
             print(series['data']['max'])
-            print([100*compute_energy_saving(4,2,series['L'],b) for b in [5,10,30]])
+            print([100*compute_energy_saving(H,N,series['L'],b,profile) for b in series['data']['B']])
             print()
 
     return KPI_energy_values, KPI_round_values, df_summary
 
 
+# ==============================================================================
+def get_kpi_memo(memo_file, memo_size=4096):
+    '''
+    Return the KPI memo stored in `memo_file`, loaded once per process.
+    '''
+    memo_file = Path(memo_file).resolve()
+    memo = kpi_memos.get(memo_file)
+    if memo is None:
+        memo = KPIMemo(memo_file, memo_size)
+        kpi_memos[memo_file] = memo
+    memo.max_entries = memo_size
+    return memo
+
+
+# ==============================================================================
+def evaluate_kpis(jobs, to_plot=[], verbose=False, memo=None, workers=1, stats=None):
+    '''
+    Compute the KPI of a list of (data, KPI) jobs.
+
+    The results found in `memo` are reused; the others are computed, by a
+    pool of `workers` processes if workers > 1, and added to the memo.
+    Returns the list of (test, KPI_value) pairs, in the order of `jobs`.
+    '''
+    results = [None]*len(jobs)
+    keys    = [None]*len(jobs)
+
+    # Look up the memo
+    to_compute = []
+    for index, (data, KPI) in enumerate(jobs):
+        if memo is not None:
+            keys[index] = kpi_key(data, KPI)
+            results[index] = memo.get(keys[index])
+        if results[index] is None:
+            to_compute.append(index)
+    if stats is not None:
+        stats.count('kpis_memoized', len(jobs) - len(to_compute))
+        stats.count('kpis_computed', len(to_compute))
+
+    # Compute the missing KPIs
+    analysis = partial(analysis_kpi_job, to_plot=to_plot, verbose=verbose)
+    job_list = [jobs[index] for index in to_compute]
+    if workers > 1 and not to_plot and len(to_compute) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            computed = list(executor.map(analysis, job_list))
+    else:
+        computed = [analysis(job) for job in job_list]
+
+    for index, (test, KPI_value) in zip(to_compute, computed):
+        # Same types as the memoized results (see `KPIMemo.get`)
+        results[index] = (bool(test), float(KPI_value))
+        if memo is not None:
+            memo.put(keys[index], test, KPI_value)
+
+    return results
+
+
+# ==============================================================================
+def analysis_kpi_job(job, to_plot=[], verbose=False):
+    '''
+    triscale.analysis_kpi on a (data, KPI) job.
+    '''
+    import triscale
+    data, KPI = job
+    return triscale.analysis_kpi(data, KPI, to_plot, verbose=verbose)
+
+
 # ==============================================================================
 def parse_test_series(  series_data,
                         raw_data_folder,
@@ -191,18 +339,67 @@ def parse_test_series(  series_data,
                         plot=True,
                         plot_save=False,
                         plot_layout={},
+                        plot_show=True,
+                        plot_binned=False,
                         verbose=False,
-                        sample=None):
+                        sample=None,
+                        workers=1,
+                        chunksize=4,
+                        incremental=False,
+                        hash_content=False,
+                        storage='csv',
+                        columns=None,
+                        cache=True,
+                        compress_error_logs=False,
+                        stats=None):
+    '''
+    Parse the raw data of a test series, or retrieve the processed data if
+    available (unless `force_computation` is set).
+
+    plot_show:    display the plots of the series (see `plot_series`);
+                  otherwise, they are only saved (if `plot_save`) in a
+                  headless batch export, rendered by `workers` processes
+                  and skipping the figures whose data did not change.
+    plot_binned:  draw pre-binned histograms, which keeps the size of the
+                  figures independent of the number of samples.
+    workers:      number of processes used to parse the tests in parallel;
+                  1 processes the tests serially in the current process.
+    chunksize:    number of tests sent at once to each worker process.
+    incremental:  parse only the tests that are new or modified since the
+                  processed data was last computed (according to the
+                  manifest saved next to the processed data); the rows of
+                  the other tests are kept from the processed files.
+    hash_content: include a hash of the raw files in their fingerprint
+                  (otherwise, only their size and modification time).
+    storage:      format of the processed data files: 'csv', 'parquet' or
+                  'feather' (see src.ttnet_storage). If only the CSV files
+                  exist, they are converted to that format on first load.
+    columns:      optional list of columns to load (besides the
+                  `test_number` index); each DataFrame keeps the listed
+                  columns it contains.
+    cache:        keep the processed data in memory once loaded; later calls
+                  return the same DataFrames without reading the files again,
+                  as long as the files are unchanged (see `clear_series_cache`).
+                  The cached DataFrames are shared: do not modify them in place.
+    compress_error_logs: gzip the serial outputs of the failed nodes, saved
+                  in `results_error_logs` (as `<test>_<node>.gz`).
+    stats:        optional PipelineStats collecting the stage timings and
+                  counters, including those of the worker processes (see
+                  src.ttnet_profiling).
+
+    The discard reason of the discarded nodes is saved next to the processed
+    data (`serieX_discards`, see `read_discards`).
+
+    Returns the per-node DataFrame and the per-test metric DataFrame.
+    '''
 
     # Series metadata
     serie               = series_data['label']
     node_lists          = series_data['node_list']
-    print("Parsing %s ..." % serie)
 
     # Raw data
     raw_data_folder     = Path(raw_data_folder)
     raw_data_folder     = raw_data_folder / serie
-    data_folder         = raw_data_folder / "results"
     logs_folder         = raw_data_folder / "results_error_logs"
 
     # Output data folder
@@ -210,35 +407,47 @@ def parse_test_series(  series_data,
     out_folder          = out_folder / serie
     if not os.path.exists(out_folder):
         os.makedirs(out_folder)
-    out_file            = out_folder / (serie+'_all.csv')
-    metric_file         = out_folder / (serie+'_metrics.csv')
+    out_file            = processed_file(out_folder, serie, 'all', storage)
+    metric_file         = processed_file(out_folder, serie, 'metrics', storage)
+    discard_file        = processed_file(out_folder, serie, 'discards', storage)
+    if storage == 'csv':
+        manifest_file   = out_folder / (serie+'_manifest.json')
+    else:
+        manifest_file   = out_folder / (serie+'_manifest_'+storage+'.json')
 
     # Plot folder
     plot_folder         = Path("plots")
     plot_folder         = plot_folder / serie
 
-    # Debug counter
-    counter_possible_time_sync_errors = 0
-
-    if not force_computation:
-        try:
-            df_all = pd.read_csv(out_file)
-            df_all.set_index('test_number', drop=True, inplace=True)
-            df_metric = pd.read_csv(metric_file)
-            df_metric.set_index('test_number', drop=True, inplace=True)
-            print('%s : Processed data retrieved (not computed).' % serie)
+    # Retrieve the processed data from the in-memory cache
+    use_cache = cache and not force_computation and not incremental
+    if use_cache:
+        cache_key = (serie,
+                     storage,
+                     None if columns is None else tuple(columns),
+                     str(out_folder.resolve()))
+        files_fingerprint = fingerprint_files([out_file, metric_file])
+        cached = series_cache.get(cache_key)
+        if cached is not None and cached[0] == files_fingerprint:
+            df_all, df_metric = cached[1], cached[2]
+            if stats is not None:
+                stats.count('series_cached')
+            if verbose:
+                print('%s : Processed data retrieved (cached).' % serie)
             if plot:
                 plot_series(df_all,
                             custom_layout=plot_layout,
                             save=plot_save,
+                            show=plot_show,
+                            binned=plot_binned,
+                            workers=workers,
                             plot_path=plot_folder,
                             prefix=serie+'_',
                             sample=sample)
             return df_all, df_metric
-        except FileNotFoundError:
-            print('No existing file found. Computing.')
 
-    out_data = []
+    print("Parsing %s ..." % serie)
+
     out_data_labels = ['test_number',
                       'date_time',
                       'B_n_slots',
@@ -253,7 +462,6 @@ def parse_test_series(  series_data,
                       'T_on_without_round',
                       'energy_savings']
 
-    metric_data = []
     metric_data_labels = ['test_number',
                       'date_time',
                       'B_n_slots',
@@ -264,223 +472,482 @@ def parse_test_series(  series_data,
                       'T_round',
                       'energy_savings']
 
-    folder_list = [test_folder for test_folder in os.listdir(str(data_folder)) if os.path.isdir(os.path.join(str(data_folder), test_folder))]
-    for test_folder in sorted(folder_list):
+    discard_labels = ['test_number',
+                      'node_id',
+                      'reason']
+
+    # Columns to load
+    if columns is not None:
+        all_columns    = [c for c in columns if c in out_data_labels]
+        metric_columns = [c for c in columns if c in metric_data_labels]
+        if storage != 'csv':
+            # The dates come with their UTC offset (see `typed_frame`)
+            for selected in [all_columns, metric_columns]:
+                if 'date_time' in selected:
+                    selected.insert(selected.index('date_time') + 1, 'date_time_offset')
+
+    if not force_computation and not incremental:
+        try:
+            with stage(stats, 'load'):
+                if (storage != 'csv' and not out_file.is_file()
+                        and processed_file(out_folder, serie, 'all', 'csv').is_file()):
+                    # Processed data only available as CSV: convert it once
+                    print('%s : Converting the processed CSV data to %s.' % (serie, storage))
+                    import_csv(out_folder, serie, storage)
+                if columns is None:
+                    df_all = read_processed(out_file, storage)
+                    df_metric = read_processed(metric_file, storage)
+                else:
+                    df_all = read_processed(out_file, storage, all_columns)
+                    df_metric = read_processed(metric_file, storage, metric_columns)
+            if stats is not None:
+                stats.count('series_loaded')
+            print('%s : Processed data retrieved (not computed).' % serie)
+            if use_cache:
+                series_cache[cache_key] = (files_fingerprint, df_all, df_metric)
+            if plot:
+                plot_series(df_all,
+                            custom_layout=plot_layout,
+                            save=plot_save,
+                            show=plot_show,
+                            binned=plot_binned,
+                            workers=workers,
+                            plot_path=plot_folder,
+                            prefix=serie+'_',
+                            sample=sample)
+            return df_all, df_metric
+        except FileNotFoundError:
+            print('No existing file found. Computing.')
+
+    with stage(stats, 'discover'):
+        # Raw data: `results` folder or archive, plain or compressed files
+        raw_series  = RawSeries(raw_data_folder)
+        folder_list = raw_series.tests()
+
+        # Fingerprint the raw data of all tests (in archive order)
+        manifest = {}
+        for test_folder in raw_series.archive_order(folder_list):
+            manifest[test_folder] = {'fingerprint' : raw_series.fingerprint(test_folder,
+                                                                            hash_content)}
+
+    # Find the tests to (re-)parse
+    to_parse = folder_list
+    df_all_kept      = None
+    df_metric_kept   = None
+    df_discards_kept = None
+    if incremental and not force_computation:
+        try:
+            with open(manifest_file, 'r') as f:
+                previous_manifest = json.load(f)
+            # Exact float parsing, such that the kept rows are written back unchanged
+            csv_options = {'float_precision':'round_trip'} if storage == 'csv' else {}
+            with stage(stats, 'load'):
+                df_all_kept = read_processed(out_file, storage, **csv_options)
+                df_metric_kept = read_processed(metric_file, storage, **csv_options)
+                df_discards_kept = read_processed(discard_file, storage)
+        except FileNotFoundError:
+            print('No existing file or manifest found. Computing.')
+            df_all_kept      = None
+            df_metric_kept   = None
+            df_discards_kept = None
+        else:
+            to_parse = []
+            for test_folder in folder_list:
+                previous = previous_manifest.get(test_folder)
+                if (previous is not None
+                        and previous['fingerprint'] == manifest[test_folder]['fingerprint']):
+                    manifest[test_folder]['test_number'] = previous['test_number']
+                else:
+                    to_parse.append(test_folder)
+
+            # Drop the rows of modified or deleted tests
+            stale_tests = [previous_manifest[test_folder]['test_number']
+                           for test_folder in previous_manifest
+                           if 'test_number' not in manifest.get(test_folder, {})]
+            df_all_kept    = df_all_kept.loc[~df_all_kept.index.isin(stale_tests)]
+            df_metric_kept = df_metric_kept.loc[~df_metric_kept.index.isin(stale_tests)]
+            df_discards_kept = df_discards_kept.loc[~df_discards_kept.index.isin(stale_tests)]
+
+            print('%s : %d new or modified tests, %d unchanged.'
+                  % (serie, len(to_parse), len(folder_list) - len(to_parse)))
+
+            if not to_parse and not stale_tests:
+                # Nothing changed: the processed data is up-to-date
+                if plot:
+                    plot_series(df_all_kept,
+                                custom_layout=plot_layout,
+                                save=plot_save,
+                                show=plot_show,
+                                binned=plot_binned,
+                                workers=workers,
+                                plot_path=plot_folder,
+                                prefix=serie+'_',
+                                sample=sample)
+                if columns is not None:
+                    df_all_kept    = df_all_kept[all_columns]
+                    df_metric_kept = df_metric_kept[metric_columns]
+                return df_all_kept, df_metric_kept
+
+    parse = partial(parse_test if stats is None else parse_test_with_stats,
+                    raw_series,
+                    logs_folder,
+                    node_lists,
+                    H=H,
+                    N=N,
+                    verbose=verbose,
+                    compress_error_logs=compress_error_logs)
+    # Tests are parsed in archive order, such that compressed archives are
+    # decompressed once (by each worker process)
+    parse_order = raw_series.archive_order(to_parse)
+    with ExitStack() as pool:
+        # The pool is shut down on exit, also on errors (the tests not
+        # started yet are then cancelled)
+        if workers > 1:
+            # Tests are independent: spread them over a pool of processes.
+            # `map` returns the results in submission order, hence the outputs
+            # are identical to the serial processing.
+            executor = ProcessPoolExecutor(max_workers=workers)
+            pool.callback(executor.shutdown, cancel_futures=True)
+            results  = executor.map(parse, parse_order, chunksize=chunksize)
+        else:
+            results  = map(parse, parse_order)
+        if parse_order != to_parse:
+            # Collect the results in the order of the test folders
+            results = dict(zip(parse_order, results))
+            results = [results[test_folder] for test_folder in to_parse]
+
+        # Typed columnar buffers of the results
+        out_data    = SeriesBuffer(out_data_labels)
+        metric_data = SeriesBuffer(metric_data_labels)
+        discards    = SeriesBuffer(discard_labels)
+        node_ids    = np.array(node_lists)
+
+        parse_start = time.perf_counter()
+        for test_folder, result in zip(to_parse, results):
+            if stats is not None:
+                result, test_stats = result
+                stats.merge(test_stats)
+            (test_data, test_metric, messages, test_discards) = result
+            manifest[test_folder]['test_number'] = int(test_metric[0])
+            test_info = dict(zip(metric_data_labels[:7], test_metric[:7]))
+            out_data.append(len(node_lists),
+                            node_id=node_lists,
+                            **test_info,
+                            **dict(zip(out_data_labels[8:], test_data.T)))
+            metric_data.append(1, **dict(zip(metric_data_labels, test_metric)))
+            discarded = test_discards.nonzero()[0]
+            discards.append(len(discarded),
+                            test_number=test_metric[0],
+                            node_id=node_ids[discarded],
+                            reason=test_discards[discarded])
+            for message in messages:
+                print(message)
+
+    if stats is not None:
+        # Wall-clock time of the parsing (the per-test stages are summed
+        # over the worker processes)
+        stats.add_time('parse', time.perf_counter() - parse_start)
+        stats.count('tests_parsed', len(to_parse))
+
+    # Save the DataFrames to csv
+    with stage(stats, 'dataframe'):
+        df_metric   = metric_data.to_frame()
+        df_all      = out_data.to_frame()
+        df_discards = discards.to_frame()
+        n_time_sync = int((df_discards['reason'] == Discard.TIME_SYNC).sum())
+
+        if storage != 'csv':
+            # Compact dtypes, as when reading back the processed data
+            df_metric = typed_frame(df_metric)
+            df_all    = typed_frame(df_all)
+
+        if df_all_kept is not None:
+            # Merge with the kept rows, in the order of the test folders
+            test_rank = {manifest[test_folder]['test_number'] : rank
+                         for rank, test_folder in enumerate(folder_list)}
+            df_metric   = merge_test_rows(df_metric_kept, df_metric, test_rank)
+            df_all      = merge_test_rows(df_all_kept, df_all, test_rank)
+            df_discards = merge_test_rows(df_discards_kept, df_discards, test_rank)
+
+    with stage(stats, 'write'):
+        write_processed(df_metric, metric_file, storage)
+        write_processed(df_all, out_file, storage)
+        write_processed(df_discards, discard_file, storage)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    # Debug outputs:
+    if verbose:
+        print('Number of possible time sync error: %d' % n_time_sync)
+
+    if plot:
+        with stage(stats, 'plot'):
+            plot_series(df_all,
+                        custom_layout=plot_layout,
+                        save=plot_save,
+                        show=plot_show,
+                        binned=plot_binned,
+                        workers=workers,
+                        plot_path=plot_folder,
+                        prefix=serie+'_')
+
+    if columns is not None:
+        df_all    = df_all[all_columns]
+        df_metric = df_metric[metric_columns]
+
+    return df_all, df_metric
+
+
+# ==============================================================================
+def parse_test(         raw_series,
+                        logs_folder,
+                        node_lists,
+                        test_folder,
+                        H=4,
+                        N=2,
+                        verbose=False,
+                        compress_error_logs=False,
+                        stats=None):
+    '''
+    Parse the results of one test, `test_folder` of `raw_series` (RawSeries).
+    The serial outputs of the nodes missing some data are saved in
+    `logs_folder` (see `write_node_logs`). Stage timings and counters are
+    added to `stats` (PipelineStats), if given.
+
+    Returns a tuple (out_data, metric_data, messages, discards)
+    with the results of the nodes (float array with one row per node in
+    `node_lists`: T_round, T_round_1slot, T_on_round, T_on_without_round
+    and energy_savings), the metric row of the test,
+    the list of verbose messages (empty if not verbose), and the discard
+    reason of each node (Discard codes, 0 if the node data is kept).
+    '''
+
+    # Read the raw files of the test in their order in the archive (a
+    # compressed archive is only read forward). The serial log is parsed in
+    # a single pass for all nodes; it stays open until the lines of the
+    # nodes that failed, if any, are written.
+    with ExitStack() as open_logs:
+        tables    = []
+        log_size  = 0
+        log_lines = 0
+        for file_name in raw_series.file_order(test_folder):
+            if file_name == "testsummary.csv":
+                # Collect test information from summary
+                with stage(stats, 'summary_read'):
+                    with raw_series.open(test_folder, file_name) as f:
+                        df_current = pd.read_csv(f, delimiter = ',')
+            else:
+                blocks, read_log = open_logs.enter_context(raw_series.log_blocks(test_folder, file_name))
+                with stage(stats, 'log_scan'):
+                    for block in blocks:
+                        tables.append(extract_events(block, node_lists))
+                        log_size += len(block)
+                        if stats is not None:
+                            log_lines += block.count(b'\n')
 
-        # Collect test information from summary
-        df_current = pd.read_csv( str(data_folder / test_folder / "testsummary.csv"), delimiter = ',')
         test_nb = df_current.at[0,"test_number"]
         payload = df_current.at[0,"L_payload_size"]
         n_slots = df_current.at[0,"B_n_slots"]
         rand_seed = df_current.at[0,"R_random_seed"]
         date_time = df_current.at[0,"date_time"]
 
-        # Open the test serial log
-        f = open( str(data_folder / test_folder / "serial.csv"), "r")
-
-        test_result = np.zeros((len(node_lists), 5), dtype=np.float)
-        node_index  = 0
-
-        for node_id in node_lists:
-
-            # reset file read offset
-            f.seek(0, 0)
-
-            # tmp log
-            first_measure = True        # Flag for the first time we measure Tround
-            nrg_log = []
-            lat_log = []
-            counter = 2* (n_slots + 1)  # number of lines with useful information to extract
-            missed_error = 0            # number of times the node missed the control packet of a slot
-                                        # -> abort scanning after twice:
-                                        # -> T,E data becomes highly unreliable
-
-            # read first line
-            line = f.readline()
-            while counter != 0 and line != '':
-                if line[0]=='#':
-                    line = f.readline()
-                    continue
-
-                tmp = line[0:-1].split(',')
-                if int(tmp[2]) == node_id:
-
-                    '''
-                    `sched rcv` is printed when a node successfuly bootstrap.
-                    The rest of the message shows the control message payload.
-                    A value of `1` marks the round where the measurement is taken.
-                    If a node bootstrap in the measuring round, the measured value is irrelevant,
-                    as nodes start measuring from the start of the bootstrapping attempt.
-                    -> Discard this value.
-                    '''
-                    if "sched rcv (1" in tmp[4]:
-                        error_log = str(test_nb) + ' : Node ' + str(node_id) + ' bootstrapped on measured round'
-                        error_log = error_log + '; discard it.'
-                        if verbose:
-                            print(error_log)
-                        break
-
-                    # Count the number of rounds with a slot miss
-                    if "Missed 1 slots! Binary: 1" in tmp[4]:
-                        missed_error += 1
-
-                    # Count the number of rounds with a control miss
-                    if "Schedule missed or corrupted" in tmp[4]:
-                        missed_error += 1
-
-                    if missed_error >= 2:
-                        error_log = str(test_nb) + ' : Node ' + str(node_id) + ' multiple slot/control misses, data is unreliable'
-                        error_log = error_log + '; discard it.'
-                        if verbose:
-                            print(error_log)
-                        break
-
-                    if "3] Missed 1 slots! Binary: 1" in tmp[4]:
-                        counter_possible_time_sync_errors += 1
-                        error_log = str(test_nb) + ' : Node ' + str(node_id) + ' may suffer from the time sync error'
-                        error_log = error_log + '; discard it.'
-                        if verbose:
-                            print(error_log)
-                        break
-
-                    if "E: " in tmp[4]:
-                        (trash, nrg) = tmp[4].split('E: ')
-                        #print(nrg)
-                        nrg_log.append(int(nrg))
-                        counter -= 1
-
-                    if "T: " in tmp[4]:
-                        # Check that the first measurement happens in the
-                        # correct round
-                        if first_measure:
-                            if "4] T: " in tmp[4]:
-                                # Fine
-                                first_measure = False
-                            else:
-                                # Nor fine
-                                error_log = str(test_nb) + ' : Node ' + str(node_id) + ' missed first measure round'
-                                error_log = error_log + '; discard it.'
-                                if verbose:
-                                    print(error_log)
-                                break
-                        (trash, lat) = tmp[4].split('T: ')
-                        lat_log.append(int(lat))
-                        counter -= 1
-
-                line = f.readline()
-
-            # Log test results
-            if counter != 0:
-                # Data is missing! Likely, this node failed to execute correctly
-                # Discard all data from this node
-                error_log = str(test_nb) + ' : Node ' + str(node_id) + ' missing some data'
-                error_log = error_log + '; discard it.'
-                if verbose:
-                    print(error_log)
+        with stage(stats, 'log_scan'):
+            events = concat_events(tables)
+            node_states = scan_events(events, node_lists, n_slots)
+
+        # Log the serial output of the nodes missing some data for inspection
+        failed_nodes = [node_id for node_id in node_lists
+                        if node_states[node_id]['counter'] != 0]
+        if failed_nodes:
+            with stage(stats, 'node_logs'):
+                write_node_logs(read_log(), failed_nodes, logs_folder, test_nb,
+                                compress=compress_error_logs)
+
+    if stats is not None:
+        validation_start = time.perf_counter()
+        stats.count('log_bytes', log_size)
+        stats.count('log_lines', log_lines)
+        stats.count('events', len(events['event']))
+        stats.count('nodes_parsed', len(node_lists))
+        stats.count('nodes_missing_data', len(failed_nodes))
+
+    messages = []
+
+    # Discard reason of each node (the first one found)
+    discards = np.zeros(len(node_lists), dtype=np.int8)
+
+    test_result = np.zeros((len(node_lists), 5), dtype=np.float64)
+    node_index  = 0
 
-                # Log the node serial output for inspection
-                log_file = str(test_nb) + "_" + str(node_id)
-                log_file = logs_folder / log_file
-                string = str(node_id) + "," + str(node_id) + ","
-                cmd = "sed '/" + string + "/!d' " + str(data_folder / test_folder / "serial.csv") + "> " + str(log_file)
-                os.system(cmd)
+    for node_id in node_lists:
 
+        state   = node_states[node_id]
+        nrg_log = state['nrg_log']
+        lat_log = state['lat_log']
+        counter = state['counter']
+
+        if state['discard'] is not None:
+            discards[node_index] = state['discard']
+            if verbose:
+                messages.append(discard_message(test_nb, node_id, state['discard']))
+
+        # Log test results
+        if counter != 0:
+            # Data is missing! Likely, this node failed to execute correctly
+            # Discard all data from this node
+            if not discards[node_index]:
+                discards[node_index] = Discard.MISSING_DATA
+            if verbose:
+                messages.append(discard_message(test_nb, node_id, Discard.MISSING_DATA))
+
+            test_result[node_index][0] = np.nan
+            test_result[node_index][1] = np.nan
+            test_result[node_index][2] = np.nan
+            test_result[node_index][3] = np.nan
+            test_result[node_index][4] = np.nan
+        else:
+
+            # double-check the values
+            '''
+            If the first measurement we have is smaller than the expected
+            length of one round, this means the node missed the round
+            where the measurement round took place (because it bootstrapped
+            very late, or simply because it failed receiving the control packet).
+            -> Discard the data from that node.
+            '''
+            T_round_1slot_theo = compute_T_round(H,N,payload,1)*1000 # in us
+            if lat_log[0] < T_round_1slot_theo:
+                # We missed the round with B slots, discard data
                 test_result[node_index][0] = np.nan
                 test_result[node_index][1] = np.nan
                 test_result[node_index][2] = np.nan
                 test_result[node_index][3] = np.nan
                 test_result[node_index][4] = np.nan
+                discards[node_index] = Discard.MISSED_MEASURING_ROUND
+                if verbose:
+                    messages.append(discard_message(test_nb, node_id, Discard.MISSED_MEASURING_ROUND))
             else:
+                test_result[node_index][0] = nrg_log[0]         # T_on_round
+                test_result[node_index][1] = sum(nrg_log[1:])   # T_on_without_round
+                test_result[node_index][2] = lat_log[0]         # T_round
+                test_result[node_index][3] = max(lat_log[1:])   # T_round_1slot
+                test_result[node_index][4] = ((test_result[node_index][1]
+                                              - test_result[node_index][0])
+                                              / test_result[node_index][1])*100 # energy_savings
+
+        # Increment the node index
+        node_index += 1
+
+    # Compute the metrics for the test
+    T_round            = np.nanmax(test_result,axis=0)[2]
+    energy_savings     = np.nanmedian(test_result,axis=0)[4]
+    if np.isnan(T_round) or energy_savings.min() < 0 or T_round.min() < 0:
+        if verbose:
+            messages.append(str(test_nb) + ' completely failed!')
+        if stats is not None:
+            stats.count('tests_failed')
+        T_round = np.nan
+        energy_savings = np.nan
+    # Save the metri data
+    metric_data = [
+                    test_nb,
+                    date_time,
+                    n_slots,
+                    payload,
+                    rand_seed,
+                    H,
+                    N,
+                    T_round,
+                    energy_savings
+                  ]
+
+    # Node data, in the order of the output columns
+    out_data = test_result[:, [2, 3, 0, 1, 4]]
+
+    if stats is not None:
+        stats.add_time('validation', time.perf_counter() - validation_start)
+        for reason, n_nodes in enumerate(np.bincount(discards, minlength=len(Discard))):
+            if reason and n_nodes:
+                stats.count('discarded: ' + Discard(reason).name.lower(), int(n_nodes))
+
+    return out_data, metric_data, messages, discards
 
-                # double-check the values
-                '''
-                If the first measurement we have is smaller than the expected
-                length of one round, this means the node missed the round
-                where the measurement round took place (because it bootstrapped
-                very late, or simply because it failed receiving the control packet).
-                -> Discard the data from that node.
-                '''
-                T_round_1slot_theo = compute_T_round(H,N,payload,1)*1000 # in us
-                if lat_log[0] < T_round_1slot_theo:
-                    # We missed the round with B slots, discard data
-                    test_result[node_index][0] = np.nan
-                    test_result[node_index][1] = np.nan
-                    test_result[node_index][2] = np.nan
-                    test_result[node_index][3] = np.nan
-                    test_result[node_index][4] = np.nan
-                    error_log = str(test_nb) + ' : Node ' + str(node_id) + ' missed the measuring round'
-                    error_log = error_log + '; discard it.'
-                    if verbose:
-                        print(error_log)
-                else:
-                    test_result[node_index][0] = nrg_log[0]         # T_on_round
-                    test_result[node_index][1] = sum(nrg_log[1:])   # T_on_without_round
-                    test_result[node_index][2] = lat_log[0]         # T_round
-                    test_result[node_index][3] = max(lat_log[1:])   # T_round_1slot
-                    test_result[node_index][4] = ((test_result[node_index][1]
-                                                  - test_result[node_index][0])
-                                                  / test_result[node_index][1])*100 # energy_savings
-
-            # Save the node data
-            out_data.append([
-                                test_nb,
-                                date_time,
-                                n_slots,
-                                payload,
-                                rand_seed,
-                                H,
-                                N,
-                                node_id,
-                                test_result[node_index][2],
-                                test_result[node_index][3],
-                                test_result[node_index][0],
-                                test_result[node_index][1],
-                                test_result[node_index][4]
-                            ])
-
-            # Increment the node index
-            node_index += 1
-
-        # Compute the metrics for the test
-        T_round            = np.nanmax(test_result,axis=0)[2]
-        energy_savings     = np.nanmedian(test_result,axis=0)[4]
-        if np.isnan(T_round) or energy_savings.min() < 0 or T_round.min() < 0:
-            if verbose:
-                print(str(test_nb) + ' completely failed!')
-            T_round = np.nan
-            energy_savings = np.nan
-        # Save the metri data
-        metric_data.append([
-                            test_nb,
-                            date_time,
-                            n_slots,
-                            payload,
-                            rand_seed,
-                            H,
-                            N,
-                            T_round,
-                            energy_savings
-                        ])
 
-    # Save the DataFrames to csv
-    df_metric = pd.DataFrame(metric_data, columns=metric_data_labels)
-    df_metric.set_index('test_number', drop=True, inplace=True)
-    df_metric.to_csv(metric_file)
+# ==============================================================================
+def discard_message(test_nb, node_id, reason):
+    '''
+    Verbose message reporting that the data of a node is discarded.
+    '''
+    return '%s : Node %s %s; discard it.' % (test_nb, node_id, discard_messages[reason])
 
-    df_all = pd.DataFrame(out_data, columns=out_data_labels)
-    df_all.set_index('test_number', drop=True, inplace=True)
-    df_all.to_csv(out_file)
 
-    # Debug outputs:
-    if verbose:
-        print('Number of possible time sync error: %d'
-                % counter_possible_time_sync_errors)
+# ==============================================================================
+def parse_test_with_stats(*args, **kwargs):
+    '''
+    parse_test, collecting the stats of the test in a new PipelineStats
+    (e.g., in a worker process). Returns the result of parse_test and the stats.
+    '''
+    stats = PipelineStats()
+    return parse_test(*args, stats=stats, **kwargs), stats
 
-    if plot:
-        plot_series(df_all,
-                    custom_layout=plot_layout,
-                    save=plot_save,
-                    plot_path=plot_folder,
-                    prefix=serie+'_')
 
-    return df_all, df_metric
+# ==============================================================================
+def merge_test_rows(df_kept, df_new, test_rank):
+    '''
+    Concatenate the rows of two DataFrames indexed by test number and sort
+    them by `test_rank` (test number -> rank), keeping the order of the
+    rows within each test.
+    '''
+    df = pd.concat([df_kept, df_new])
+    rank = np.array([test_rank[test_nb] for test_nb in df.index])
+    return df.iloc[np.argsort(rank, kind='stable')]
+
+
+# ==============================================================================
+def fingerprint_files(file_list):
+    '''
+    Size and modification time of a list of files (None for missing files).
+    '''
+    fingerprint = []
+    for file_path in file_list:
+        try:
+            stat = os.stat(str(file_path))
+        except FileNotFoundError:
+            fingerprint.append(None)
+        else:
+            fingerprint.append((stat.st_size, stat.st_mtime_ns))
+    return fingerprint
+
+
+# ==============================================================================
+def read_discards(series_data, out_data_folder, storage='csv'):
+    '''
+    Discarded nodes of a parsed series, as a DataFrame indexed by test number
+    with the `node_id` and the discard `reason` (categorical, named after
+    the Discard members). E.g., the number of discards per node and reason:
+
+        df.groupby(['node_id', 'reason'], observed=True).size().unstack(fill_value=0)
+    '''
+    serie = series_data['label']
+    df = read_processed(processed_file(Path(out_data_folder) / serie, serie, 'discards', storage),
+                        storage)
+    names = [reason.name for reason in Discard]
+    df['reason'] = pd.Categorical.from_codes(df['reason'].astype(int), categories=names)
+    return df
+
+
+# ==============================================================================
+def plot_series(*args, **kwargs):
+    '''
+    src.ttnet_plots.plot_series, importing the plotting modules on first use.
+    '''
+    from src.ttnet_plots import plot_series
+    return plot_series(*args, **kwargs)
+
+
+# ==============================================================================
+def clear_series_cache():
+    '''
+    Drop all the processed series kept in memory by parse_test_series.
+    '''
+    series_cache.clear()
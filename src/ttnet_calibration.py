@@ -0,0 +1,297 @@
+"""
+Calibration of the TTnet model parameters against measured series data.
+
+Fits selected parameters of a ModelProfile (e.g., `Td`, `T_gap`,
+`T_round_end`) to the round lengths (`T_round`) and radio-on times
+(`T_on_round`) of the processed series (`serieX_all.csv`), and returns the
+calibrated profile:
+
+    df = load_measurements([serie_1, serie_2, serie_3])
+    profile = calibrate(df, parameters=['Td', 'T_gap', 'T_round_end'], fit='upper')
+    compute_T_round(4, 2, 8, 5, profile=profile)
+
+Three fits are available:
+
+    - 'lstsq':    least squares (mean model)
+    - 'quantile': quantile regression, the model exceeding a fraction
+                  `quantile` of the measurements
+    - 'upper':    tightest upper bound, the model exceeding all measurements
+                  (with the smallest total slack)
+
+The model is linearized around the current parameter values and the fit
+iterated (Gauss-Newton), all rows being evaluated at once; the rounding of
+T_slot is ignored in the derivatives. Parameters that do not affect the
+fitted targets (e.g., `Td` for `T_round`) are kept at their value in the
+profile, in all fits. Parameters that enter the model with the same
+coefficients for all measured configurations (e.g., `Td` and `Tstart_slot`
+when H and N are fixed) cannot be told apart: the least-squares fit
+without parameter bounds then changes them as little as possible, while
+the other fits return any of the equivalent solutions.
+
+The fits use `scipy`, except the least-squares fit without parameter
+bounds (`nonnegative=False`).
+"""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.ttnet_model import ModelProfile, DPP2_CC430, compute_T_round, compute_T_on_round
+
+# Measured columns (in us) and corresponding model functions (in ms)
+targets = {'T_round'    : compute_T_round,
+           'T_on_round' : compute_T_on_round}
+
+# Columns of the processed series used for the calibration
+measurement_columns = ['B_n_slots', 'L_payload_size', 'H', 'N'] + list(targets)
+
+default_parameters = ['Td', 'T_gap', 'T_round_end']
+
+fit_types = ['lstsq', 'quantile', 'upper']
+
+# ==============================================================================
+def load_measurements(
+        series_list,
+        raw_data_folder=Path('data_raw'),
+        out_data_folder=Path('data_processed'),
+        storage='csv',
+        columns=measurement_columns):
+    '''
+    Measured rows (without the discarded nodes) of the processed series in
+    `series_list`, with the given `columns`, `test_number` and a `serie`
+    column.
+    '''
+    from src.ttnet_analysis import parse_test_series
+
+    frames = []
+    for series_data in series_list:
+        df_all, df_metric = parse_test_series(series_data,
+                                              raw_data_folder,
+                                              out_data_folder,
+                                              plot=False,
+                                              storage=storage,
+                                              columns=columns)
+        df = df_all.dropna(subset=list(targets)).reset_index()
+        df['serie'] = series_data['label']
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+# ==============================================================================
+def set_parameters(profile, parameters, values):
+    return profile._replace(**{name: float(value)
+                               for name, value in zip(parameters, values)})
+
+def model_values(profile, configurations, target_list):
+    '''
+    Model values (in ms) of all the rows, for each target, concatenated.
+    '''
+    H, N, L, B = configurations
+    return np.concatenate([targets[target](H,N,L,B,profile) for target in target_list])
+
+def model_jacobian(profile, parameters, configurations, target_list):
+    '''
+    Derivatives of the model values with respect to the parameters (central
+    differences), as an array of shape (rows, parameters). T_slot rounding
+    is made negligible, such that the derivatives are not zero.
+    '''
+    smooth = profile._replace(T_slot_base=1e-9)
+    columns = []
+    for name in parameters:
+        value = getattr(profile, name)
+        step  = 1e-4 * max(abs(value), 1.)
+        upper = model_values(smooth._replace(**{name: value + step}), configurations, target_list)
+        lower = model_values(smooth._replace(**{name: value - step}), configurations, target_list)
+        columns.append((upper - lower) / (2*step))
+    return np.column_stack(columns)
+
+# ==============================================================================
+def solve_step(J, residuals, fit, quantile, bounds):
+    '''
+    Parameter step `delta` of one iteration, fitting `J @ delta` to the
+    residuals (measured - model values) according to `fit`.
+
+    bounds: (lower, upper) limits of `delta`, or None
+    '''
+    n_parameters = J.shape[1]
+
+    if fit == 'lstsq':
+        if bounds is None:
+            return np.linalg.lstsq(J, residuals, rcond=None)[0]
+        from scipy.optimize import lsq_linear
+        return lsq_linear(J, residuals, bounds=bounds).x
+
+    from scipy.optimize import linprog
+
+    if fit == 'upper':
+        # min sum(J delta - residuals)  s.t.  J delta >= residuals
+        if bounds is None:
+            bounds = [(None, None)]*n_parameters
+        else:
+            bounds = [(None if np.isinf(low) else low, None if np.isinf(high) else high)
+                      for low, high in zip(*bounds)]
+        result = linprog(J.sum(axis=0),
+                         A_ub=-J, b_ub=-residuals,
+                         bounds=bounds, method='highs')
+        if not result.success:
+            raise RuntimeError('Calibration failed: %s' % result.message)
+        return result.x
+
+    # Quantile regression, solved in its dual form (one variable per row in
+    # [0,1], one constraint per parameter), which is much faster than the
+    # primal form; the step is given by the dual values of the constraints.
+    # Parameters out of their bounds are fixed at the bound, and the others
+    # fitted again.
+    delta = np.zeros(n_parameters)
+    free  = np.ones(n_parameters, dtype=bool)
+    while free.any():
+        J_free = J[:, free]
+        result = linprog(-(residuals - J[:, ~free] @ delta[~free]),
+                         A_eq=J_free.T, b_eq=(1 - quantile)*J_free.sum(axis=0),
+                         bounds=(0, 1), method='highs')
+        if not result.success:
+            raise RuntimeError('Calibration failed: %s' % result.message)
+        delta[free] = -result.eqlin.marginals
+        if bounds is None:
+            break
+        violated = free & ((delta < bounds[0]) | (delta > bounds[1]))
+        if not violated.any():
+            break
+        delta[violated] = np.clip(delta[violated], bounds[0][violated], bounds[1][violated])
+        free &= ~violated
+    return delta
+
+# ==============================================================================
+def calibrate(
+        measurements,
+        parameters=default_parameters,
+        fit='lstsq',
+        quantile=0.95,
+        target_list=list(targets),
+        profile=DPP2_CC430,
+        parameter_bounds=None,
+        nonnegative=True,
+        max_iterations=10,
+        tolerance=1e-9,
+        verbose=False):
+    '''
+    Fit `parameters` of the model `profile` to the `measurements`.
+
+    measurements:     DataFrame with the `measurement_columns` (values in us,
+                      as in the processed series; see `load_measurements`).
+    parameters:       names of the ModelProfile fields to fit; the other
+                      fields, and the parameters that do not affect the
+                      targets, are kept from `profile`.
+    fit:              'lstsq', 'quantile' or 'upper' (see the module docstring).
+    quantile:         fraction of the measurements below the model ('quantile').
+    target_list:      measured columns fitted (jointly), among `targets`.
+    parameter_bounds: optional {parameter: (lower, upper)} limits of the
+                      fitted values (None for no limit).
+    nonnegative:      the fitted values are at least 0, unless other limits
+                      are given in `parameter_bounds`.
+
+    Returns the calibrated ModelProfile.
+    '''
+    if fit not in fit_types:
+        raise ValueError('Unknown fit: %s' % fit)
+    unknown = set(parameters) - set(ModelProfile._fields)
+    if unknown:
+        raise ValueError('Unknown model parameters: %s' % ', '.join(sorted(unknown)))
+    if 'T_slot_base' in parameters:
+        raise ValueError('T_slot_base cannot be calibrated.')
+
+    configurations = [measurements[column].to_numpy(dtype=float)
+                      for column in ['H', 'N', 'L_payload_size', 'B_n_slots']]
+    measured = np.concatenate([measurements[target].to_numpy(dtype=float) / 1000
+                               for target in target_list]) # in ms
+
+    # Parameters with zero derivatives do not affect the targets: their
+    # values are left to the solver otherwise
+    scale = np.abs(model_jacobian(profile, parameters, configurations, target_list)).max(axis=0)
+    fixed = [name for name, column in zip(parameters, scale) if column <= 1e-9 * scale.max()]
+    if len(fixed) == len(parameters):
+        raise ValueError('None of the parameters %s affects the targets %s.'
+                         % (', '.join(parameters), ', '.join(target_list)))
+    if fixed:
+        if verbose:
+            print('Not fitted (no effect on the targets): %s' % ', '.join(fixed))
+        parameters = [name for name in parameters if name not in fixed]
+
+    # Limits of the fitted values
+    limits = None
+    if parameter_bounds or nonnegative:
+        default_limits = (0, None) if nonnegative else (None, None)
+        limits = [(parameter_bounds or {}).get(name, default_limits) for name in parameters]
+        limits = (np.array([-np.inf if low is None else low for low, high in limits]),
+                  np.array([np.inf if high is None else high for low, high in limits]))
+
+    model = model_values(profile, configurations, target_list)
+    for iteration in range(max_iterations):
+        values = np.array([getattr(profile, name) for name in parameters], dtype=float)
+        J = model_jacobian(profile, parameters, configurations, target_list)
+        bounds = None if limits is None else (limits[0] - values, limits[1] - values)
+
+        delta = solve_step(J, measured - model, fit, quantile, bounds)
+        profile = set_parameters(profile, parameters, values + delta)
+
+        # Done when the step is negligible, or when the linearized model was
+        # exact (the model is affine in the fitted parameters)
+        new_model = model_values(profile, configurations, target_list)
+        converged = (np.all(np.abs(delta) <= tolerance * np.maximum(np.abs(values), 1.))
+                     or np.allclose(new_model, model + J @ delta, rtol=0, atol=1e-6))
+        model = new_model
+        if converged:
+            break
+
+    if verbose:
+        print(calibration_summary(profile, measurements, target_list))
+
+    return profile
+
+# ==============================================================================
+def calibration_summary(profile, measurements, target_list=list(targets)):
+    '''
+    Text summary of the fit of `profile` to the `measurements`, per target:
+    mean and maximal error (in ms), and fraction of the measurements
+    exceeding the model (by more than 1 ns).
+    '''
+    configurations = [measurements[column].to_numpy(dtype=float)
+                      for column in ['H', 'N', 'L_payload_size', 'B_n_slots']]
+    lines = ['%-12s %10s %10s %10s' % ('target', 'mean err', 'max err', 'violations')]
+    for target in target_list:
+        error = (measurements[target].to_numpy(dtype=float) / 1000
+                 - model_values(profile, configurations, [target]))
+        lines.append('%-12s %10.4f %10.4f %9.2f%%'
+                     % (target, error.mean(), error.max(), 100*np.mean(error > 1e-6)))
+    return '\n'.join(lines)
+
+# ==============================================================================
+def main():
+    from src.ttnet_analysis import serie_1, serie_2, serie_3
+
+    parser = argparse.ArgumentParser(description='Calibrate the TTnet model parameters.')
+    parser.add_argument('--parameters', nargs='+', default=default_parameters,
+                        help='model parameters to fit')
+    parser.add_argument('--fit', choices=fit_types, default='lstsq')
+    parser.add_argument('--quantile', type=float, default=0.95,
+                        help='quantile of the measurements bounded by the model (quantile fit)')
+    parser.add_argument('--targets', nargs='+', choices=list(targets), default=list(targets),
+                        help='measured values fitted')
+    parser.add_argument('--storage', default='csv',
+                        help='format of the processed data files')
+    args = parser.parse_args()
+
+    measurements = load_measurements([serie_1, serie_2, serie_3], storage=args.storage)
+    profile = calibrate(measurements,
+                        parameters=args.parameters,
+                        fit=args.fit,
+                        quantile=args.quantile,
+                        target_list=args.targets,
+                        verbose=True)
+    print()
+    for name in args.parameters:
+        print('%-16s %.9g  (was %.9g)' % (name, getattr(profile, name), getattr(DPP2_CC430, name)))
+
+if __name__ == '__main__':
+    main()
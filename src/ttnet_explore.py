@@ -0,0 +1,139 @@
+"""
+Design-space exploration for TTnet configurations.
+
+Sweeps (H,N,L,B) grids through the vectorized TTnet model and keeps only the
+Pareto front of round length (to minimize) against energy savings (to
+maximize). Grids are evaluated chunk by chunk, such that the full grid is
+never built in memory.
+"""
+
+import numpy as np
+import pandas as pd
+
+from src.ttnet_model import DPP2_CC430, compute_T_round, compute_energy_saving
+
+front_labels = ['H', 'N', 'L', 'B', 'T_round', 'energy_saving']
+
+# ==============================================================================
+def iter_grid_chunks(Hs, Ns, Ls, Bs, chunk_size=2**20):
+    '''
+    Iterate over the cartesian product of Hs, Ns, Ls and Bs by chunks of
+    at most `chunk_size` configurations.
+
+    Yields (H, N, L, B) tuples of flat arrays. The grid is enumerated in
+    C order (B varies fastest) and never materialized as a whole.
+    '''
+    axes  = [np.asarray(v).ravel() for v in (Hs, Ns, Ls, Bs)]
+    shape = tuple(len(a) for a in axes)
+    n_points = int(np.prod(shape, dtype=np.int64))
+
+    for start in range(0, n_points, chunk_size):
+        flat_index = np.arange(start, min(start + chunk_size, n_points), dtype=np.int64)
+        indexes = np.unravel_index(flat_index, shape)
+        yield tuple(a[i] for a, i in zip(axes, indexes))
+
+# ==============================================================================
+def pareto_front(T_round, energy_saving):
+    '''
+    Return the indexes of the configurations that are Pareto-optimal, i.e.,
+    for which no other configuration has both a shorter (or equal) round
+    length and larger energy savings.
+
+    Indexes are sorted by increasing round length (hence increasing energy
+    savings). Among identical (T_round, energy_saving) pairs, only the first
+    one is kept.
+    '''
+    T_round       = np.asarray(T_round)
+    energy_saving = np.asarray(energy_saving)
+    if T_round.size == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Sort by increasing round length, then decreasing energy savings;
+    # lexsort is stable, which keeps the first of identical points
+    order = np.lexsort((-energy_saving, T_round))
+    E_sorted = energy_saving[order]
+
+    # A point is on the front iff it strictly improves the energy savings
+    # of all the points with shorter (or equal) round length
+    best_before = np.maximum.accumulate(E_sorted)
+    keep = np.empty(len(order), dtype=bool)
+    keep[0] = True
+    keep[1:] = E_sorted[1:] > best_before[:-1]
+
+    return order[keep]
+
+# ==============================================================================
+def explore_design_space(
+        Hs,
+        Ns,
+        Ls,
+        Bs,
+        T_round_max=None,
+        chunk_size=2**20,
+        profile=DPP2_CC430,
+        ):
+    '''
+    Evaluate the TTnet model over the (Hs,Ns,Ls,Bs) grid and return the
+    Pareto front of round length against energy savings.
+
+    T_round_max: optional round-length deadline (in ms); configurations
+                 exceeding it are discarded.
+    chunk_size:  number of configurations evaluated per vectorized call;
+                 bounds the memory usage independently of the grid size.
+    profile:     model parameters (see src.ttnet_model.ModelProfile).
+
+    Returns a DataFrame with columns `front_labels`, sorted by increasing
+    round length. `energy_saving` is a ratio (not in percent).
+    '''
+    front = [np.empty(0, dtype=np.int64)]*4 + [np.empty(0)]*2
+
+    for H, N, L, B in iter_grid_chunks(Hs, Ns, Ls, Bs, chunk_size):
+
+        T_round       = compute_T_round(H,N,L,B,profile)
+        energy_saving = compute_energy_saving(H,N,L,B,profile)
+
+        if T_round_max is not None:
+            valid = T_round <= T_round_max
+            if not valid.any():
+                continue
+            H, N, L, B = H[valid], N[valid], L[valid], B[valid]
+            T_round, energy_saving = T_round[valid], energy_saving[valid]
+
+        # Reduce the chunk to its own front before merging: the merged
+        # front then stays small whatever the chunk size
+        idx = pareto_front(T_round, energy_saving)
+        candidates = [np.concatenate((f, c[idx])) for f, c in
+                      zip(front, (H, N, L, B, T_round, energy_saving))]
+
+        idx = pareto_front(candidates[4], candidates[5])
+        front = [c[idx] for c in candidates]
+
+    return pd.DataFrame(dict(zip(front_labels, front)), columns=front_labels)
+
+# ==============================================================================
+def best_configuration(
+        Hs,
+        Ns,
+        Ls,
+        Bs,
+        T_round_max,
+        chunk_size=2**20,
+        profile=DPP2_CC430,
+        ):
+    '''
+    Return the configuration of the (Hs,Ns,Ls,Bs) grid that maximizes the
+    energy savings while meeting the round-length deadline `T_round_max`
+    (in ms). Ties are broken in favour of the shortest round length.
+
+    Returns a Series indexed by `front_labels`, or None if no configuration
+    meets the deadline.
+    '''
+    front = explore_design_space(Hs, Ns, Ls, Bs,
+                                 T_round_max=T_round_max,
+                                 chunk_size=chunk_size,
+                                 profile=profile)
+    if front.empty:
+        return None
+
+    # The front is sorted by increasing round length and energy savings
+    return front.iloc[-1]
@@ -0,0 +1,385 @@
+"""
+Serial log processing for the TTnet experiments on FlockLab.
+
+A serial log (`serial.csv`) interleaves the outputs of all the nodes of a
+test, one line per output:
+
+    timestamp,observer_id,node_id,direction,output
+
+Each log is scanned in a single pass, through a read-only memory map: the
+log is never copied into Python objects and may be larger than the memory.
+The lines carrying a TTnet event are located by searching the event markers
+in the whole buffer (a C-level substring search, much faster than splitting
+every line in Python); only those lines are split, and only the lines of
+the tracked nodes are classified into a compact event table. The events of
+each node then go through a state machine that applies the discard rules.
+
+The outputs of the nodes that failed are written next to the raw data for
+inspection (`write_node_logs`). Their lines are only located once the scan
+is over, and only if some nodes failed: the content of the log is then
+read again by blocks of bounded size (from the memory map, which stays
+open, or from a spool of the decompressed log; see `RawSeries.log_blocks`).
+"""
+
+import gzip
+import mmap
+import os
+import re
+from contextlib import ExitStack, contextmanager
+from enum import IntEnum
+
+import numpy as np
+
+# Discard reasons of the node data (stored as integer codes)
+class Discard(IntEnum):
+    NONE                   = 0  # data is kept
+    BOOTSTRAP              = 1
+    MISSES                 = 2
+    TIME_SYNC              = 3
+    FIRST_MEASURE          = 4
+    MISSING_DATA           = 5
+    MISSED_MEASURING_ROUND = 6
+
+# Description of the discard reasons, as printed in verbose mode
+discard_messages = {Discard.BOOTSTRAP              : 'bootstrapped on measured round',
+                    Discard.MISSES                 : 'multiple slot/control misses, data is unreliable',
+                    Discard.TIME_SYNC              : 'may suffer from the time sync error',
+                    Discard.FIRST_MEASURE          : 'missed first measure round',
+                    Discard.MISSING_DATA           : 'missing some data',
+                    Discard.MISSED_MEASURING_ROUND : 'missed the measuring round'}
+
+# Event types
+EVENT_BOOTSTRAP     = 0     # `sched rcv (1`: bootstrap in the measuring round
+EVENT_SLOT_MISS     = 1     # `Missed 1 slots! Binary: 1`
+EVENT_SCHEDULE_MISS = 2     # `Schedule missed or corrupted`
+EVENT_ENERGY        = 3     # `E: <radio-on time>`
+EVENT_LATENCY       = 4     # `T: <round length>`
+
+# Markers of the lines that may carry an event
+event_markers = [b"sched rcv (1",
+                 b"Missed 1 slots! Binary: 1",
+                 b"Schedule missed or corrupted",
+                 b"E: ",
+                 b"T: "]
+
+# Round printed before a latency or slot miss event, e.g. `[4] T: 42144`
+latency_round_regex   = re.compile(rb'(\d)\] T: ')
+slot_miss_round_regex = re.compile(rb'(\d)\] Missed 1 slots! Binary: 1')
+
+# ==============================================================================
+@contextmanager
+def open_serial_log(file_path):
+    '''
+    Open a serial log as a read-only memory map (bytes-like object).
+    '''
+    with open(str(file_path), 'rb') as f:
+        try:
+            log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            yield b''
+            return
+        try:
+            yield log
+        finally:
+            log.close()
+
+# ==============================================================================
+def event_line_starts(log):
+    '''
+    Sorted offsets of the start of the lines of `log` (bytes-like) that
+    contain at least one event marker.
+    '''
+    starts = set()
+    for marker in event_markers:
+        position = log.find(marker)
+        while position != -1:
+            start = log.rfind(b'\n', 0, position) + 1
+            starts.add(start)
+            # Continue the search from the next line
+            end = log.find(b'\n', position)
+            if end == -1:
+                break
+            position = log.find(marker, end)
+    return sorted(starts)
+
+# ==============================================================================
+def message_events(message):
+    '''
+    Classify a node output (bytes) into its events, as a list of
+    (event, round, value) tuples, in the order in which they are processed.
+    '''
+    events = []
+
+    if b"sched rcv (1" in message:
+        events.append((EVENT_BOOTSTRAP, -1, 0))
+        return events
+
+    if b"Missed 1 slots! Binary: 1" in message:
+        match = slot_miss_round_regex.search(message)
+        events.append((EVENT_SLOT_MISS, -1 if match is None else int(match.group(1)), 0))
+
+    if b"Schedule missed or corrupted" in message:
+        events.append((EVENT_SCHEDULE_MISS, -1, 0))
+
+    if b"E: " in message:
+        (trash, nrg) = message.split(b'E: ')
+        events.append((EVENT_ENERGY, -1, int(nrg)))
+
+    if b"T: " in message:
+        match = latency_round_regex.search(message)
+        (trash, lat) = message.split(b'T: ')
+        events.append((EVENT_LATENCY, -1 if match is None else int(match.group(1)), int(lat)))
+
+    return events
+
+# ==============================================================================
+def extract_events(log, node_lists=None):
+    '''
+    Extract the TTnet events from the content of a serial log: a bytes-like
+    object (e.g., from `open_serial_log`) or a string.
+
+    node_lists: optional ids of the nodes whose events are extracted
+                (all nodes by default)
+
+    Returns the event table, as a dictionary of arrays (one entry per event,
+    in log order):
+        'node_id': id of the node printing the event
+        'event':   event type (EVENT_*)
+        'round':   round digit printed before the event (-1 if none)
+        'value':   value of energy and latency events (0 otherwise)
+    '''
+    if isinstance(log, str):
+        log = log.encode()
+    if node_lists is not None:
+        node_lists = set(node_lists)
+
+    node_ids = []
+    events   = []
+    rounds   = []
+    values   = []
+
+    for start in event_line_starts(log):
+        end = log.find(b'\n', start)
+        if end == -1:
+            end = len(log)
+        line = log[start:end]
+        if line[0:1] == b'#':
+            continue
+
+        # Only the event lines are copied out of the buffer
+        tmp = line.split(b',')
+        node_id = int(tmp[2])
+        if node_lists is not None and node_id not in node_lists:
+            continue
+
+        for event, round_id, value in message_events(tmp[4]):
+            node_ids.append(node_id)
+            events.append(event)
+            rounds.append(round_id)
+            values.append(value)
+
+    return {'node_id' : np.array(node_ids, dtype=np.int32),
+            'event'   : np.array(events, dtype=np.int8),
+            'round'   : np.array(rounds, dtype=np.int8),
+            'value'   : np.array(values, dtype=np.int64)}
+
+# ==============================================================================
+def concat_events(tables):
+    '''
+    Concatenate event tables (see `extract_events`), e.g., extracted from
+    consecutive blocks of a log.
+    '''
+    tables = list(tables)
+    if len(tables) == 1:
+        return tables[0]
+    return {key: np.concatenate([table[key] for table in tables])
+            for key in ['node_id', 'event', 'round', 'value']}
+
+# ==============================================================================
+def new_node_state(n_slots):
+    '''
+    Initial parsing state of a node, for a test with `n_slots` slots.
+    '''
+    return {
+        'first_measure' : True,              # Flag for the first time we measure Tround
+        'nrg_log'       : [],
+        'lat_log'       : [],
+        'counter'       : 2* (n_slots + 1),  # number of lines with useful information to extract
+        'missed_error'  : 0,                 # number of times the node missed the control packet of a slot
+                                             # -> abort scanning after twice:
+                                             # -> T,E data becomes highly unreliable
+        'discard'       : None,              # discard reason, if any
+    }
+
+# ==============================================================================
+def process_node_event(state, event, round_id, value):
+    '''
+    Update the parsing state of a node with one of its events.
+
+    Sets state['discard'] (Discard) when the node data must be discarded. Once the
+    node is discarded or all the expected values are collected
+    (state['counter'] == 0), further events must not be processed.
+    '''
+
+    '''
+    `sched rcv` is printed when a node successfuly bootstrap.
+    The rest of the message shows the control message payload.
+    A value of `1` marks the round where the measurement is taken.
+    If a node bootstrap in the measuring round, the measured value is irrelevant,
+    as nodes start measuring from the start of the bootstrapping attempt.
+    -> Discard this value.
+    '''
+    if event == EVENT_BOOTSTRAP:
+        state['discard'] = Discard.BOOTSTRAP
+
+    elif event == EVENT_SLOT_MISS or event == EVENT_SCHEDULE_MISS:
+        # Count the number of rounds with a slot or control miss
+        state['missed_error'] += 1
+        if state['missed_error'] >= 2:
+            state['discard'] = Discard.MISSES
+        elif event == EVENT_SLOT_MISS and round_id == 3:
+            state['discard'] = Discard.TIME_SYNC
+
+    elif event == EVENT_ENERGY:
+        state['nrg_log'].append(value)
+        state['counter'] -= 1
+
+    elif event == EVENT_LATENCY:
+        # Check that the first measurement happens in the
+        # correct round
+        if state['first_measure']:
+            if round_id == 4:
+                # Fine
+                state['first_measure'] = False
+            else:
+                # Nor fine
+                state['discard'] = Discard.FIRST_MEASURE
+                return
+        state['lat_log'].append(value)
+        state['counter'] -= 1
+
+# ==============================================================================
+def scan_events(events, node_lists, n_slots):
+    '''
+    Run the state machine of each node over an event table
+    (see `extract_events`).
+
+    node_lists: ids of the nodes to parse
+    n_slots:    number of slots in the measured round (B)
+
+    Returns a dictionary mapping each node id to its final parsing state
+    (see `new_node_state`).
+    '''
+    nodes = {node_id: new_node_state(n_slots) for node_id in node_lists}
+    active = len(nodes)
+
+    for node_id, event, round_id, value in zip(events['node_id'].tolist(),
+                                               events['event'].tolist(),
+                                               events['round'].tolist(),
+                                               events['value'].tolist()):
+        state = nodes.get(node_id)
+        if state is None or state['counter'] == 0 or state['discard'] is not None:
+            continue
+
+        process_node_event(state, event, round_id, value)
+        if state['counter'] == 0 or state['discard'] is not None:
+            active -= 1
+            if active == 0:
+                break
+
+    return nodes
+
+# ==============================================================================
+def scan_serial_log(log, node_lists, n_slots):
+    '''
+    Parse the content of a serial log (bytes-like object or string) in a
+    single pass.
+
+    Returns a dictionary mapping each node id to its final parsing state
+    (see `new_node_state`).
+    '''
+    return scan_events(extract_events(log, node_lists), node_lists, n_slots)
+
+# ==============================================================================
+def line_nodes(log, node_lists=None, chunk_lines=1 << 16):
+    '''
+    Offsets of the lines of `log` (bytes-like) and id of the node printing
+    each line (`node_id` field), vectorized over the lines: the lines are
+    never split in Python.
+
+    node_lists: optional ids of the nodes whose lines are returned (all
+                nodes by default); comment lines are skipped.
+
+    Returns three arrays: start and end offsets of the lines (the end
+    including the line terminator) and node ids.
+    '''
+    if isinstance(log, str):
+        log = log.encode()
+    buffer = np.frombuffer(log, dtype=np.uint8)
+    size = len(buffer)
+    ends = np.flatnonzero(buffer == ord('\n')) + 1
+    if size and buffer[-1] != ord('\n'):
+        ends = np.append(ends, size)
+    starts = np.concatenate(([0], ends[:-1]))[:len(ends)].astype(ends.dtype)
+
+    # Node id: digits between the second and third commas of the line,
+    # located by chunks of lines to bound the size of the temporary arrays
+    node_ids = np.full(len(starts), -1, dtype=np.int64)
+    digits = np.arange(9)
+    for first in range(0, len(starts), chunk_lines):
+        lines = slice(first, first + chunk_lines)
+        line_starts, line_ends = starts[lines], ends[lines]
+        commas = np.flatnonzero(buffer[line_starts[0]:line_ends[-1]] == ord(',')) + line_starts[0]
+        if len(commas) < 3:
+            continue
+        k = np.searchsorted(commas, line_starts)
+        valid = k + 2 < len(commas)
+        k = np.minimum(k, len(commas) - 3)
+        field_start = commas[k+1] + 1
+        length = commas[k+2] - field_start
+        valid &= (commas[k+2] < line_ends) & (length > 0) & (length <= len(digits))
+        valid &= buffer[line_starts] != ord('#')
+        index = field_start[:, None] + digits
+        in_field = digits < length[:, None]
+        text = buffer[np.minimum(index, size - 1)].astype(np.int64) - ord('0')
+        is_digit = (text >= 0) & (text <= 9)
+        valid &= (is_digit | ~in_field).all(axis=1)
+        place = np.where(in_field, length[:, None] - 1 - digits, 0)
+        values = (np.where(in_field, text, 0) * 10**place).sum(axis=1)
+        node_ids[lines] = np.where(valid, values, -1)
+
+    keep = node_ids >= 0
+    if node_lists is not None:
+        keep &= np.isin(node_ids, list(node_lists))
+    return starts[keep], ends[keep], node_ids[keep]
+
+# ==============================================================================
+def write_node_logs(blocks, node_ids, logs_folder, test_nb, compress=False):
+    '''
+    Write the lines printed by each node of `node_ids` to
+    `logs_folder/<test_nb>_<node_id>` (gzip-compressed, with a `.gz` suffix,
+    if `compress` is set).
+
+    blocks: content of the serial log, as an iterable of blocks of complete
+            lines (bytes-like); the lines of the nodes are selected block by
+            block, such that the memory used is bounded by the block size.
+    '''
+    if not node_ids:
+        return
+    os.makedirs(str(logs_folder), exist_ok=True)
+    with ExitStack() as node_logs:
+        files = {}
+        for node_id in node_ids:
+            log_file = os.path.join(str(logs_folder), '%s_%s' % (test_nb, node_id))
+            if compress:
+                files[node_id] = node_logs.enter_context(gzip.open(log_file + '.gz', 'wb'))
+            else:
+                files[node_id] = node_logs.enter_context(open(log_file, 'wb'))
+
+        for block in blocks:
+            starts, ends, block_nodes = line_nodes(block, node_ids)
+            for node_id in node_ids:
+                rows = np.flatnonzero(block_nodes == node_id)
+                files[node_id].writelines(block[start:end] for start, end
+                                          in zip(starts[rows].tolist(), ends[rows].tolist()))
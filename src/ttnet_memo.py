@@ -0,0 +1,92 @@
+"""
+Persistent memoization of the TriScale KPI results.
+
+The result of `triscale.analysis_kpi` only depends on the data samples and
+on the KPI definition (percentile, confidence, bounds, ...). Results are
+stored in a JSON file, keyed on a hash of both, and bounded in number:
+the least recently used entries are dropped first.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+# ==============================================================================
+def kpi_key(data, KPI):
+    '''
+    Hash of a data sample array and a KPI definition (dictionary).
+    '''
+    data = np.ascontiguousarray(data)
+    sha = hashlib.sha1()
+    sha.update(str(data.dtype).encode())
+    sha.update(str(data.shape).encode())
+    sha.update(data.tobytes())
+    sha.update(json.dumps(KPI, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+# ==============================================================================
+class KPIMemo:
+    '''
+    Size-bounded (LRU) memo of KPI results, persisted in `memo_file`.
+
+    Values are (test, KPI_value) pairs as returned by `triscale.analysis_kpi`.
+    '''
+
+    def __init__(self, memo_file, max_entries=4096):
+        self.memo_file   = Path(memo_file)
+        self.max_entries = max_entries
+        self.entries     = OrderedDict()
+        self.modified    = False
+        try:
+            with open(str(self.memo_file), 'r') as f:
+                self.entries.update(json.load(f))
+        except (FileNotFoundError, ValueError):
+            # No memo yet, or a corrupted one: start from scratch
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        Return the memoized (test, KPI_value) pair, or None.
+        '''
+        value = self.entries.get(key)
+        if value is None:
+            return None
+        self.entries.move_to_end(key)
+        return bool(value[0]), float(value[1])
+
+    def put(self, key, test, KPI_value):
+        self.entries[key] = [bool(test), float(KPI_value)]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.modified = True
+
+    def save(self):
+        '''
+        Write the memo to disk, if it has been modified.
+        '''
+        if not self.modified:
+            return
+        if not self.memo_file.parent.exists():
+            os.makedirs(str(self.memo_file.parent))
+        tmp_file = self.memo_file.with_name(self.memo_file.name + '.tmp')
+        with open(str(tmp_file), 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(str(tmp_file), str(self.memo_file))
+        self.modified = False
+
+    def clear(self):
+        '''
+        Drop all entries, in memory and on disk.
+        '''
+        self.entries.clear()
+        self.modified = False
+        if self.memo_file.exists():
+            os.remove(str(self.memo_file))
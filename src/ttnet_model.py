@@ -5,9 +5,31 @@ Glossy values from the DPP2-cc430 implementation
 
 @author: Romain Jacob
 @date: 10.04.2020
+
+All compute_* functions accept scalars or NumPy arrays. Array arguments are
+broadcast against each other, such that a whole (H,N,L,B) grid can be
+evaluated in a single call, e.g.
+
+    compute_T_round(4, 2, np.array([8,16,64])[:,None], np.arange(1,35))
+
+returns an array of shape (3,34). Scalar inputs return scalars. NumPy is
+only imported for array inputs, such that the module imports quickly.
+
+The model parameters are grouped in an immutable (hashable) ModelProfile,
+passed as the `profile` argument of the compute_* functions; the default is
+DPP2_CC430, i.e., the module constants below. Other radios or firmware
+versions are modelled by deriving a profile, e.g.
+
+    faster_radio = DPP2_CC430._replace(Rbits=500, Tstart_slot=0.05)
+    compute_T_round(4, 2, 8, 5, profile=faster_radio)
+
+Changing the module constants has no effect on the default profile.
+Several profiles can be evaluated at once over the same grid with
+`evaluate_profiles`.
 '''
 
 import math
+from typing import NamedTuple
 
 # == Radio parameters ==
 L_cal       = 3         # Bytes Length of calibration Bytes
@@ -35,68 +57,132 @@ T_slot_base     = 0.5   # ms Granularity of T_slot values
 T_post_cb       = 1     # ms Time for the on_slot_post_cb() of the last slot [to measure, depends on the application]
 T_round_end     = 1.5   # ms Time for state-keeping at the end of the Baloo round [upper-bounded to 0.5ms]
 
-def compute_T_beacon(H,N):
+# ==============================================================================
+class ModelProfile(NamedTuple):
+    '''
+    Parameters of the TTnet time and energy model (see the module constants
+    for their meaning and units).
+    '''
+    L_cal:          float = L_cal
+    L_header:       float = L_header
+    Rbits:          float = Rbits
+    Tcal:           float = Tcal
+    Theader:        float = Theader
+    Twu_data:       float = Twu_data
+    Twu_control:    float = Twu_control
+    Tstart_slot:    float = Tstart_slot
+    Td:             float = Td
+    TdeepWU:        float = TdeepWU
+    L_beacon:       float = L_beacon
+    T_gap:          float = T_gap
+    T_gap_control:  float = T_gap_control
+    T_guard:        float = T_guard
+    T_preprocess:   float = T_preprocess
+    T_switch:       float = T_switch
+    T_slack:        float = T_slack
+    T_slot_base:    float = T_slot_base
+    T_post_cb:      float = T_post_cb
+    T_round_end:    float = T_round_end
+
+# Default profile: Glossy on DPP2-cc430 with the TTnet implementation above
+DPP2_CC430 = ModelProfile()
+
+def stack_profiles(profiles, ndim=0):
+    '''
+    Stack a sequence of profiles into a single ModelProfile of arrays, of
+    shape (len(profiles),) + (1,)*ndim, which broadcasts against
+    `ndim`-dimensional (H,N,L,B) inputs.
+    '''
+    import numpy as np
+    shape = (len(profiles),) + (1,)*ndim
+    return ModelProfile(*[np.array(values, dtype=float).reshape(shape)
+                          for values in zip(*profiles)])
+
+def evaluate_profiles(function, profiles, *args):
+    '''
+    Evaluate a compute_* `function` for each of the `profiles` over the same
+    (H,N,L,B) inputs `args`, in a single vectorized call, e.g.
+
+        evaluate_profiles(compute_T_round, profiles, 4, 2, Ls[:,None], Bs)
+
+    Returns an array of shape (len(profiles),) + broadcast shape of `args`.
+    '''
+    import numpy as np
+    ndim = np.broadcast(*args).ndim
+    return function(*args, profile=stack_profiles(profiles, ndim))
+
+# ==============================================================================
+def compute_T_beacon(H,N,profile=DPP2_CC430):
     '''
     T_beacon = T_guard + (H + 2*N -1) * (8*( L_header + L_beacon )/Rbits + T_switch) + T_slack
 
     computed in ms
     '''
-    return T_guard + (H + 2*N -1) * (8*( L_header + L_beacon )/Rbits + T_switch) + T_slack
+    p = profile
+    return p.T_guard + (H + 2*N -1) * (8*( p.L_header + p.L_beacon )/p.Rbits + p.T_switch) + p.T_slack
 
-def compute_T_slot(H,N,L):
+def compute_T_slot(H,N,L,profile=DPP2_CC430):
     '''
     T_slot(L) = ceil( (H + 2*N -1) * (8*( L_header + L )/Rbits + T_switch) + T_slack )
 
     rounded up to T_slot_base
     computed in ms
     '''
-    T_slot = (H + 2*N -1) * (8*( L_header + L )/Rbits + T_switch) + T_slack
+    p = profile
+    T_slot = (H + 2*N -1) * (8*( p.L_header + L )/p.Rbits + p.T_switch) + p.T_slack
 
     # round up to T_slot_base
-    T_slot = T_slot_base * math.ceil(T_slot / T_slot_base)
+    if isinstance(T_slot, (int, float)):
+        T_slot = p.T_slot_base * math.ceil(T_slot / p.T_slot_base)
+    else:
+        import numpy as np
+        T_slot = p.T_slot_base * np.ceil(T_slot / p.T_slot_base)
 
     return T_slot
 
-def compute_T_round(H,N,L,B):
+def compute_T_round(H,N,L,B,profile=DPP2_CC430):
     '''
     T_round(B,L) = T_preprocess + T_beacon + T_gap_control + B*T_slot(L) + (B-1)* T_gap + T_round_end
     '''
-    T_beacon = compute_T_beacon(H,N)
-    T_slot   = compute_T_slot(H,N,L)
-    return T_preprocess + T_beacon + T_gap_control + B*T_slot + (B-1)* T_gap + T_round_end
+    p = profile
+    T_beacon = compute_T_beacon(H,N,p)
+    T_slot   = compute_T_slot(H,N,L,p)
+    return p.T_preprocess + T_beacon + p.T_gap_control + B*T_slot + (B-1)* p.T_gap + p.T_round_end
 
-def compute_T_on_beacon(H,N):
+def compute_T_on_beacon(H,N,profile=DPP2_CC430):
     '''
     T_on_beacon = T_start_slot + T_guard + (H + 2*N -1) * (T_d + T_cal + T_header + 8*L_beacon/Rbits)
     '''
-    return Tstart_slot + T_guard + (H + 2*N -1) * (Td + Tcal + Theader + 8*L_beacon/Rbits)
+    p = profile
+    return p.Tstart_slot + p.T_guard + (H + 2*N -1) * (p.Td + p.Tcal + p.Theader + 8*p.L_beacon/p.Rbits)
 
-def compute_T_on_slot(H,N,L):
+def compute_T_on_slot(H,N,L,profile=DPP2_CC430):
     '''
     T_on_slot(L) = T_start_slot + T_guard + (H + 2*N -1) * (T_d + T_cal + T_header + 8*L/Rbits)
     '''
-    return Tstart_slot + T_guard + (H + 2*N -1) * (Td + Tcal + Theader + 8*L/Rbits)
+    p = profile
+    return p.Tstart_slot + p.T_guard + (H + 2*N -1) * (p.Td + p.Tcal + p.Theader + 8*L/p.Rbits)
 
-def compute_T_on_round(H,N,L,B):
+def compute_T_on_round(H,N,L,B,profile=DPP2_CC430):
     '''
     T_on_round = T_on_beacon + B*T_on_slot(L)
     '''
-    T_on_beacon = compute_T_on_beacon(H,N)
-    T_on_slot   = compute_T_on_slot(H,N,L)
+    T_on_beacon = compute_T_on_beacon(H,N,profile)
+    T_on_slot   = compute_T_on_slot(H,N,L,profile)
     return T_on_beacon + B*T_on_slot
 
-def compute_T_on_no_round(H,N,L,B):
+def compute_T_on_no_round(H,N,L,B,profile=DPP2_CC430):
     '''
     T_on_no-round(B,L) = B * (T_on_beacon + T_on_slot(L))
     '''
-    T_on_beacon   = compute_T_on_beacon(H,N)
-    T_on_slot     = compute_T_on_slot(H,N,L)
+    T_on_beacon   = compute_T_on_beacon(H,N,profile)
+    T_on_slot     = compute_T_on_slot(H,N,L,profile)
     return B*(T_on_slot + T_on_beacon)
 
-def compute_energy_saving(H,N,L,B):
+def compute_energy_saving(H,N,L,B,profile=DPP2_CC430):
     '''
     E = (T_on_no-round - T_on_round) / T_on_no-round
     '''
-    T_on_round    = compute_T_on_round(H,N,L,B)
-    T_on_no_round = compute_T_on_no_round(H,N,L,B)
+    T_on_round    = compute_T_on_round(H,N,L,B,profile)
+    T_on_no_round = compute_T_on_no_round(H,N,L,B,profile)
     return (T_on_no_round - T_on_round) / T_on_no_round
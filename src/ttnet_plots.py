@@ -5,7 +5,10 @@ Plotting functions related to the Time-Triggered Wireless project.
 @date: 10.04.2020
 """
 
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import numpy as np
@@ -14,6 +17,8 @@ import plotly.graph_objects as go
 
 import src.colors as colors
 from src.ttnet_model import *
+from src.ttnet_storage import index_configurations, configuration_rows
+from src.ttnet_memo import kpi_key
 
 # Series list
 serie_1 = {'label' : 'serie1',
@@ -121,10 +126,7 @@ def plot_protocol_overhead():
         categories.append('H = %i' % h)
 
     for b in B:
-        data = []
-        for h in H:
-            overhead = compute_T_beacon(h,N)/compute_T_round(h,N,L,b['value'])*100
-            data.append(overhead)
+        data = compute_T_beacon(np.asarray(H),N)/compute_T_round(np.asarray(H),N,L,b['value'])*100
 
         series = go.Bar(
             name='B = %s' % str(b['value']),
@@ -200,9 +202,7 @@ def plot_round_length(
         categories.append('H = %i' % h)
 
     for b in B:
-        data = []
-        for h in H:
-            data.append(compute_T_round(h,N,L,b['value']))
+        data = compute_T_round(np.asarray(H),N,L,b['value'])
 
         series = go.Bar(
             name='B = %s' % str(b['value']),
@@ -244,15 +244,67 @@ def plot_round_length(
     return fig
 
 # ==============================================================================
+# Figures of plot_series: measured column, model function, x-axis title
+series_figures = [('T_round',    compute_T_round,    'Round length Tr [ms]'),
+                  ('T_on_round', compute_T_on_round, 'Radio-on time in a round [ms]')]
+
+# File where the data hash of the exported figures is kept, in the plot folder
+plot_manifest = 'plot_manifest.json'
+
 def plot_series(
         df,
         custom_layout={},
         save=False,
         plot_path='.',
         prefix='',
-        sample=None
+        sample=None,
+        show=True,
+        workers=1,
+        force=False,
+        binned=False,
         ):
-
+    '''
+    Histograms of the round length and radio-on time of each (H,N,L,B)
+    configuration of the series, against the model.
+
+    show:    display the figures (and save them one by one, if `save`).
+             Otherwise, the figures are only rendered if `save`, in a
+             headless batch export (see `export_figures`).
+    workers: number of processes rendering the figures (headless mode).
+    force:   render all figures, even those whose data did not change
+             since the last export (headless mode).
+    binned:  draw pre-binned histograms (see `TTW_hist`).
+
+    In headless mode, returns the number of figures written and skipped.
+    '''
+    jobs = series_figure_jobs(df, custom_layout, prefix, sample, binned)
+
+    if not show:
+        if save:
+            return export_figures(jobs, plot_path, workers=workers, force=force)
+        return
+
+    for job in jobs:
+        if job['metric'] == series_figures[0][0]:
+            print("B = %u, L = %u, H = %u, N = %u" % (job['B'],job['L'],job['H'],job['N']))
+        print("  " + job['metric'])
+        fig = series_figure(job)
+        fig.show()
+        if save:
+            fig.write_image(str(Path(plot_path)/job['file']))
+
+def series_figure_jobs(
+        df,
+        custom_layout={},
+        prefix='',
+        sample=None,
+        binned=False
+        ):
+    '''
+    Description of the figures drawn by `plot_series`, one dictionary per
+    figure: configuration, metric, data samples (in ms), model value, file
+    name, layout and histogram mode.
+    '''
     Bs = df.B_n_slots.unique()
     Ls = df.L_payload_size.unique()
     Hs = df.H.unique()
@@ -263,38 +315,91 @@ def plot_series(
         if 'L' in sample:
             Ls = [sample['L']]
 
+    # Index the samples of each (H,N,L,B) configuration, in one pass
+    df = df.dropna()
+    config_index = index_configurations(df)
+
     for H in Hs:
         for N in Ns:
             for B in Bs:
                 for L in Ls:
-                    x = (df.loc[(df['B_n_slots']==B) &
-                                (df['L_payload_size']==L) &
-                                (df['H']==H) &
-                                (df['N']==N)]).dropna()
-
-                    print("B = %u, L = %u, H = %u, N = %u" % (B,L,H,N))
-
-                    print("  T_round")
-                    x_data = x.T_round/1000
-                    x_model = compute_T_round(H,N,L,B) # in ms
-                    fig = TTW_hist(x_data,0,x_model)
-                    fig.update_layout({"xaxis":{'title':'Round length Tr [ms]'}})
-                    fig.update_layout(custom_layout)
-                    fig.show()
-                    plot_filename = "%sT_round_H%u_N%u_L%u_B%u.pdf" % (prefix,H,N,L,B)
-                    if save:
-                        fig.write_image(str(plot_path/plot_filename))
-
-                    print("  T_on_round")
-                    x_data = x.T_on_round/1000
-                    x_model = compute_T_on_round(H,N,L,B) # in ms
-                    fig = TTW_hist(x_data,0,x_model)
-                    fig.update_layout({"xaxis":{'title':'Radio-on time in a round [ms]'}})
-                    fig.update_layout(custom_layout)
-                    fig.show()
-                    plot_filename = "%sT_on_round_H%u_N%u_L%u_B%u.pdf" % (prefix,H,N,L,B)
-                    if save:
-                        fig.write_image(str(plot_path/plot_filename))
+                    x = configuration_rows(df, config_index, H, N, L, B)
+                    for metric, model, title in series_figures:
+                        yield {'H'      : int(H),
+                               'N'      : int(N),
+                               'L'      : int(L),
+                               'B'      : int(B),
+                               'metric' : metric,
+                               'data'   : x[metric].to_numpy()/1000,
+                               'model'  : model(H,N,L,B), # in ms
+                               'title'  : title,
+                               'layout' : custom_layout,
+                               'binned' : binned,
+                               'file'   : "%s%s_H%u_N%u_L%u_B%u.pdf" % (prefix,metric,H,N,L,B)}
+
+def series_figure(job):
+    '''
+    Figure of one of the `series_figure_jobs`.
+    '''
+    fig = TTW_hist(job['data'],0,job['model'],binned=job['binned'])
+    fig.update_layout({"xaxis":{'title':job['title']}})
+    fig.update_layout(job['layout'])
+    return fig
+
+def write_figure(job, plot_path):
+    series_figure(job).write_image(str(Path(plot_path)/job['file']))
+
+# ==============================================================================
+def export_figures(jobs, plot_path, workers=1, force=False):
+    '''
+    Render the figures of `jobs` (see `series_figure_jobs`) to files in
+    `plot_path`, without displaying them.
+
+    The figures are split in one batch per worker process, such that each
+    process starts the image renderer once and reuses it for its whole
+    batch. The hash of the data and layout of each exported figure is kept
+    in `plot_manifest`; the figures whose hash did not change (and whose
+    file exists) are skipped, unless `force` is set.
+
+    Returns the number of figures written and skipped.
+    '''
+    plot_path = Path(plot_path)
+    os.makedirs(str(plot_path), exist_ok=True)
+    manifest_file = plot_path / plot_manifest
+
+    manifest = {}
+    if manifest_file.exists():
+        with open(str(manifest_file), 'r') as f:
+            manifest = json.load(f)
+
+    pending = []
+    n_skipped = 0
+    for job in jobs:
+        key = kpi_key(job['data'], {name: value for name, value in job.items() if name != 'data'})
+        if (not force and manifest.get(job['file']) == key
+                and (plot_path / job['file']).exists()):
+            n_skipped += 1
+            continue
+        pending.append((job, key))
+
+    if workers > 1 and len(pending) > 1:
+        chunksize = -(-len(pending) // workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(partial(write_figure, plot_path=plot_path),
+                              [job for job, key in pending],
+                              chunksize=chunksize))
+    else:
+        for job, key in pending:
+            write_figure(job, plot_path)
+
+    if pending:
+        manifest.update((job['file'], key) for job, key in pending)
+        tmp_file = manifest_file.with_name(manifest_file.name + '.tmp')
+        with open(str(tmp_file), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(str(tmp_file), str(manifest_file))
+
+    return len(pending), n_skipped
 
 
 # ==============================================================================
@@ -314,7 +419,7 @@ def plot_energy_savings_model(
     fig = go.Figure()
 
     for l in Ls:
-        data = [100*compute_energy_saving(H,N,l,b) for b in Bs]
+        data = 100*compute_energy_saving(H,N,l,np.asarray(Bs))
         series = go.Scatter(
             name='L = %sB' % l,
             x=Bs,
@@ -367,7 +472,7 @@ def plot_energy_savings(KPIs=None):
     fig = go.Figure()
 
     for l in L:
-        data = [100*compute_energy_saving(H,N,l['value'],b) for b in B]
+        data = 100*compute_energy_saving(H,N,l['value'],B)
         series = go.Scatter(
             name='L = %sB' % str(l['value']),
             x=B,
@@ -438,25 +543,48 @@ def plot_energy_savings(KPIs=None):
     return fig
 
 # ==============================================================================
-def TTW_hist(x, KPI, max_model):
+def TTW_hist(x, KPI, max_model, binned=False, nbins=None):
+    '''
+    Histogram of the samples `x` (in percent of the samples), with the
+    model value `max_model` and the largest sample.
+
+    binned: compute the histogram with NumPy and draw it as bars (see
+            `histogram_bins`), such that the figure only holds the bins
+            instead of all the samples.
+    nbins:  approximate number of bins (binned mode); chosen from the
+            samples by default.
+    '''
 
     # Vertical positioning of annotations
     top_annot = 0.95
     second_annot = 0.5
 
-
-    max_observed = max(x)
+    x = np.asarray(x)
+    max_observed = np.max(x)
 
     fig = go.Figure()
 
-    fig.add_trace(
-        go.Histogram(
-            x=x,
-            histnorm='percent',
-            # nbinsx=50,
-            marker_color=colors.accent[0]['normal'],
+    if binned:
+        edges = histogram_bins(x, nbins)
+        counts, edges = np.histogram(x, bins=edges)
+        fig.add_trace(
+            go.Bar(
+                x=(edges[:-1] + edges[1:])/2,
+                y=100*counts/len(x),
+                width=np.diff(edges),
+                marker_color=colors.accent[0]['normal'],
+                marker_line_width=0,
+            )
+        )
+    else:
+        fig.add_trace(
+            go.Histogram(
+                x=x,
+                histnorm='percent',
+                # nbinsx=50,
+                marker_color=colors.accent[0]['normal'],
+            )
         )
-    )
 
     notes = []
     shapes = []
@@ -536,3 +664,51 @@ def TTW_hist(x, KPI, max_model):
     fig.update_layout(default_layout)
 
     return fig
+
+def histogram_bins(x, nbins=None):
+    '''
+    Bin edges of a histogram of the samples `x`, following the automatic
+    binning of plotly histograms: "round" bin size (2, 5 or 10 times a
+    power of 10), from the spread of the samples (or `nbins`, the
+    approximate number of bins), with edges shifted away from the samples.
+    '''
+    x = np.asarray(x, dtype=float)
+    x_min, x_max = x.min(), x.max()
+    values = np.unique(x)
+    if len(values) == 1:
+        return np.array([x_min - 0.5, x_max + 0.5])
+
+    def round_up(size, steps):
+        power = 10**np.floor(np.log10(size))
+        return power * steps[np.searchsorted(steps, size/power)]
+
+    if nbins is not None:
+        size = (x_max - x_min) / nbins
+    else:
+        # Not smaller than the resolution of the samples
+        min_diff = np.diff(values).min()
+        power = 10**np.floor(np.log10(min_diff))
+        steps = np.array([0.9, 1.9, 4.9, 9.9])
+        min_size = power * steps[np.searchsorted(steps, min_diff/power, side='right') - 1]
+        size = max(min_size, 2*x.std()/len(x)**0.4)
+    size = round_up(size, np.array([2., 5., 10.]))
+
+    start = np.ceil(x_min/size)*size - size
+
+    # Shift the bins when many samples are on their edges
+    def near_edge(v):
+        return np.mod(1 + (v - start)*100/size, 100) < 2
+    if np.all(np.mod(x, 1) == 0):
+        if size < 1:
+            start = x_min - size/2
+        else:
+            start -= 0.5
+            if start + size < x_min:
+                start += size
+    elif np.count_nonzero(near_edge(x + size/2)) < 0.1*len(x):
+        if (np.count_nonzero(near_edge(x)) > 0.3*len(x)
+                or near_edge(x_min) or near_edge(x_max)):
+            start += size/2 if start + size/2 < x_min else -size/2
+
+    n_bins = 1 + int(np.floor((x_max - start)/size))
+    return start + size*np.arange(n_bins + 1)
@@ -0,0 +1,160 @@
+"""
+Instrumentation of the analysis pipeline.
+
+A `PipelineStats` object collects the wall-clock time spent in each stage
+of the pipeline and counters (tests parsed, log bytes and lines scanned,
+nodes discarded by reason, ...). Pass it as the `stats` argument of
+`parse_test_series` or `compute_KPIs`, then print or save the report:
+
+    stats = PipelineStats()
+    with stats.profile():                 # optional: cProfile or pyinstrument
+        compute_KPIs(..., stats=stats)
+    print(stats.summary())
+    stats.save('pipeline_stats.json')
+
+The stage timings and counters of the worker processes are merged into
+the stats of the main process; the profilers only see the main process.
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+# ==============================================================================
+class PipelineStats:
+    '''
+    Stage timers, counters and optional profile of a pipeline run.
+    '''
+
+    def __init__(self):
+        self.stages   = OrderedDict()   # stage -> [total time (s), number of calls]
+        self.counters = OrderedDict()   # counter -> value
+        self.profiles = []              # profiler outputs
+
+    # --------------------------------------------------------------------------
+    @contextmanager
+    def stage(self, name):
+        '''
+        Time a stage of the pipeline (cumulated over the calls).
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, duration, calls=1):
+        stage = self.stages.setdefault(name, [0., 0])
+        stage[0] += duration
+        stage[1] += calls
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        '''
+        Add the timings and counters of another PipelineStats (e.g., returned
+        by a worker process).
+        '''
+        for name, (duration, calls) in other.stages.items():
+            self.add_time(name, duration, calls)
+        for name, value in other.counters.items():
+            self.count(name, value)
+
+    # --------------------------------------------------------------------------
+    @contextmanager
+    def profile(self, profiler='cprofile', n_functions=30, output_file=None):
+        '''
+        Profile the enclosed code with `cProfile` ('cprofile') or
+        `pyinstrument` ('pyinstrument', if installed), and add the result to
+        the report.
+
+        n_functions: number of functions kept in the report (cProfile, by
+                     cumulative time)
+        output_file: optional file where the full profile is saved (pstats
+                     dump for cProfile, HTML for pyinstrument)
+        '''
+        if profiler == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                if output_file is not None:
+                    profile.dump_stats(str(output_file))
+                self.profiles.append({'profiler'  : 'cprofile',
+                                      'functions' : top_functions(profile, n_functions)})
+        elif profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profile = Profiler()
+            profile.start()
+            try:
+                yield
+            finally:
+                profile.stop()
+                if output_file is not None:
+                    with open(str(output_file), 'w') as f:
+                        f.write(profile.output_html())
+                self.profiles.append({'profiler' : 'pyinstrument',
+                                      'text'     : profile.output_text()})
+        else:
+            raise ValueError('Unknown profiler: %s' % profiler)
+
+    # --------------------------------------------------------------------------
+    def to_dict(self):
+        return {'stages'   : {name: {'time_s': duration, 'calls': calls}
+                              for name, (duration, calls) in self.stages.items()},
+                'counters' : dict(self.counters),
+                'profiles' : self.profiles}
+
+    def save(self, file_path):
+        '''
+        Save the report as JSON.
+        '''
+        with open(str(file_path), 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def summary(self):
+        '''
+        Text summary of the stage timings and counters.
+        '''
+        width = max([24] + [len(name) for name in list(self.stages) + list(self.counters)])
+        lines = ['%-*s %10s %8s' % (width, 'stage', 'time [s]', 'calls')]
+        for name, (duration, calls) in self.stages.items():
+            lines.append('%-*s %10.4f %8d' % (width, name, duration, calls))
+        lines.append('')
+        lines.append('%-*s %10s' % (width, 'counter', 'value'))
+        for name, value in self.counters.items():
+            lines.append('%-*s %10d' % (width, name, value))
+        return '\n'.join(lines)
+
+# ==============================================================================
+def stage(stats, name):
+    '''
+    `stats.stage(name)`, or a no-op context if `stats` is None.
+    '''
+    if stats is None:
+        return nullcontext()
+    return stats.stage(name)
+
+# ==============================================================================
+def top_functions(profile, n_functions=30):
+    '''
+    The `n_functions` functions of a cProfile profile with the largest
+    cumulative time, as a list of dictionaries.
+    '''
+    stats = pstats.Stats(profile, stream=io.StringIO())
+    stats.sort_stats('cumulative')
+    functions = []
+    for function in stats.fcn_list[:n_functions]:
+        calls, primitive_calls, total_time, cumulative_time, callers = stats.stats[function]
+        functions.append({'function'     : '%s:%d(%s)' % function,
+                          'calls'        : calls,
+                          'total_s'      : total_time,
+                          'cumulative_s' : cumulative_time})
+    return functions
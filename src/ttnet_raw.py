@@ -0,0 +1,312 @@
+"""
+Access to the raw data of the test series, plain or compressed.
+
+The raw data of a series (`data_raw/serieX/`) holds one folder per test in
+`results/`, each with a `serial.csv` and a `testsummary.csv` file. Those
+files may be compressed individually (`serial.csv.gz`, `.xz` or `.zst`),
+or the whole `results` folder may be stored as a single archive
+(`results.zip`, `results.tar`, `results.tar.gz`/`.tgz`, `results.tar.xz`
+or `results.tar.bz2`). Files are always streamed: nothing is extracted from
+the archives, and compressed logs are read by blocks of bounded size (see
+`log_blocks`), such that the memory used does not grow with the log size.
+
+A compressed tar archive is a single compressed stream, which can only be
+read forward: going back to an earlier member decompresses the archive
+again from its start. The tests and their files must therefore be read in
+archive order (see `archive_order` and `file_order`), such that the
+archive is decompressed once.
+
+The `.zst` files require the `zstandard` package.
+"""
+
+import gzip
+import hashlib
+import lzma
+import os
+import tarfile
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.ttnet_logs import open_serial_log
+
+# Raw data files of a test
+raw_files = ["serial.csv", "testsummary.csv"]
+
+# Suffixes of the compressed raw data files
+compressed_suffixes = ['.gz', '.xz', '.zst']
+
+# Names of the series archives, by type
+archive_names = {'results.zip'     : 'zip',
+                 'results.tar'     : 'tar',
+                 'results.tar.gz'  : 'tar',
+                 'results.tgz'     : 'tar',
+                 'results.tar.xz'  : 'tar',
+                 'results.tar.bz2' : 'tar'}
+
+# Size of the blocks read from the compressed logs
+block_size = 1 << 24
+
+# Size of the blocks of a log read again (see `RawSeries.log_blocks`), small
+# enough to bound the temporary arrays used to select the lines of some nodes
+reread_block_size = 1 << 20
+
+# Opened archives, by (process, path, size, modification time), shared by
+# the RawSeries of a process (e.g., by the successive chunks of tests sent
+# to a worker process). Forked processes must not share the handles of
+# their parent, which would share the file position.
+archive_handles = {}
+
+# ==============================================================================
+def decompress_stream(f, suffix):
+    '''
+    Wrap the binary file object `f` to decompress it according to the file
+    suffix (no-op if `suffix` is not one of `compressed_suffixes`).
+    '''
+    if suffix == '.gz':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if suffix == '.xz':
+        return lzma.LZMAFile(f, mode='rb')
+    if suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading .zst raw data requires the `zstandard` package.')
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    return f
+
+# ==============================================================================
+def iter_line_blocks(f, size=block_size):
+    '''
+    Read the binary file object `f` by blocks of about `size` bytes, split
+    at line boundaries (a block only holds complete lines).
+    '''
+    rest = b''
+    while True:
+        block = f.read(size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        if rest:
+            block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+
+# ==============================================================================
+class RawSeries:
+    '''
+    Raw data of a test series, located in `serie_folder` (`data_raw/serieX`),
+    either as a `results` folder or as a `results` archive (see `archive_names`).
+
+    Instances can be sent to worker processes: archives are re-opened once
+    in each process, without scanning them again.
+    '''
+
+    def __init__(self, serie_folder):
+        self.serie_folder = Path(serie_folder)
+        self.archive      = None
+        self.archive_type = None
+        self.members      = {}      # (test, file name) -> archive member
+        self.handle       = None    # opened archive (not sent to workers)
+
+        if (self.serie_folder / "results").is_dir():
+            return
+
+        for name, archive_type in archive_names.items():
+            if (self.serie_folder / name).is_file():
+                self.archive = self.serie_folder / name
+                self.archive_type = archive_type
+                break
+        else:
+            raise FileNotFoundError('No raw data found in %s (expected a `results` folder or archive)'
+                                    % self.serie_folder)
+
+        self.index_archive()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['handle'] = None
+        return state
+
+    # --------------------------------------------------------------------------
+    def open_archive(self):
+        if self.handle is None:
+            stat = os.stat(str(self.archive))
+            key = (os.getpid(), str(self.archive.resolve()), stat.st_size, stat.st_mtime_ns)
+            self.handle = archive_handles.get(key)
+            if self.handle is None:
+                if self.archive_type == 'zip':
+                    self.handle = zipfile.ZipFile(str(self.archive))
+                else:
+                    self.handle = tarfile.open(str(self.archive), 'r:*')
+                archive_handles[key] = self.handle
+        return self.handle
+
+    def index_archive(self):
+        '''
+        Map the `<test>/<file>` members of the archive (optionally under a
+        leading `results/` folder) to (test, file name) pairs.
+        '''
+        archive = self.open_archive()
+        if self.archive_type == 'zip':
+            members = [(info.filename, info) for info in archive.infolist()
+                       if not info.is_dir()]
+        else:
+            members = [(info.name, info) for info in archive.getmembers()
+                       if info.isfile()]
+        for name, info in members:
+            parts = [part for part in name.split('/') if part not in ('', '.')]
+            if parts[0] == 'results':
+                parts = parts[1:]
+            if len(parts) == 2:
+                self.members[(parts[0], parts[1])] = info
+
+    def position(self, test_folder, file_name):
+        '''
+        Position of the raw file `file_name` of a test in the archive (0 for
+        a `results` folder).
+        '''
+        actual_name, location = self.find(test_folder, file_name)
+        if self.archive is None:
+            return 0
+        if self.archive_type == 'zip':
+            return location.header_offset
+        return location.offset
+
+    # --------------------------------------------------------------------------
+    def tests(self):
+        '''
+        Sorted list of the test folders of the series.
+        '''
+        if self.archive is None:
+            data_folder = self.serie_folder / "results"
+            tests = [test_folder for test_folder in os.listdir(str(data_folder))
+                     if os.path.isdir(os.path.join(str(data_folder), test_folder))]
+        else:
+            tests = set(test_folder for test_folder, file_name in self.members)
+        return sorted(tests)
+
+    def archive_order(self, tests):
+        '''
+        The test folders `tests`, sorted by the position of their first raw
+        file in the archive (unchanged for a `results` folder).
+        '''
+        if self.archive is None:
+            return list(tests)
+        return sorted(tests, key=lambda test_folder: min(self.position(test_folder, file_name)
+                                                         for file_name in raw_files))
+
+    def file_order(self, test_folder, file_names=raw_files):
+        '''
+        The raw files `file_names` of a test, sorted by their position in
+        the archive (unchanged for a `results` folder).
+        '''
+        return sorted(file_names, key=lambda file_name: self.position(test_folder, file_name))
+
+    def find(self, test_folder, file_name):
+        '''
+        Actual name of the raw file `file_name` of a test (possibly with a
+        compression suffix), and its path or archive member.
+        '''
+        for suffix in [''] + compressed_suffixes:
+            if self.archive is None:
+                file_path = self.serie_folder / "results" / test_folder / (file_name + suffix)
+                if file_path.is_file():
+                    return file_name + suffix, file_path
+            else:
+                info = self.members.get((test_folder, file_name + suffix))
+                if info is not None:
+                    return file_name + suffix, info
+        raise FileNotFoundError('%s not found for test %s in %s'
+                                % (file_name, test_folder, self.serie_folder))
+
+    def open_raw(self, test_folder, file_name):
+        '''
+        Open the raw file `file_name` of a test, as a binary file object
+        returning its (compressed) content.
+        '''
+        actual_name, location = self.find(test_folder, file_name)
+        if self.archive is None:
+            return actual_name, open(str(location), 'rb')
+        if self.archive_type == 'zip':
+            return actual_name, self.open_archive().open(location)
+        return actual_name, self.open_archive().extractfile(location)
+
+    @contextmanager
+    def open(self, test_folder, file_name):
+        '''
+        Open the raw file `file_name` of a test, as a binary file object
+        returning its decompressed content.
+        '''
+        actual_name, f = self.open_raw(test_folder, file_name)
+        stream = decompress_stream(f, os.path.splitext(actual_name)[1])
+        try:
+            yield stream
+        finally:
+            stream.close()
+            f.close()
+
+    @contextmanager
+    def log_blocks(self, test_folder, file_name="serial.csv"):
+        '''
+        Content of a raw file, as a tuple (blocks, read_again): `blocks` is
+        an iterable of blocks of complete lines, which stay valid until the
+        context exits, and `read_again()` iterates over the content again,
+        by blocks of bounded size, once `blocks` has been consumed.
+
+        Uncompressed files are memory-mapped and returned as a single block;
+        they are read again from the memory map. Compressed files are
+        decompressed by blocks while iterating, and the decompressed blocks
+        are spooled to a temporary file, from which they are read again: the
+        raw file is never read (or decompressed) twice.
+        '''
+        actual_name, location = self.find(test_folder, file_name)
+        if self.archive is None and actual_name == file_name:
+            with open_serial_log(location) as log:
+                def read_again():
+                    if not log:
+                        return iter([])
+                    log.seek(0)
+                    return iter_line_blocks(log, reread_block_size)
+                yield [log], read_again
+        else:
+            with self.open(test_folder, file_name) as f, tempfile.TemporaryFile() as spool:
+                def blocks():
+                    for block in iter_line_blocks(f):
+                        spool.write(block)
+                        yield block
+                def read_again():
+                    spool.seek(0)
+                    return iter_line_blocks(spool, reread_block_size)
+                yield blocks(), read_again
+
+    # --------------------------------------------------------------------------
+    def fingerprint(self, test_folder, hash_content=False):
+        '''
+        Fingerprint of the raw data of a test: name, size and modification
+        time of each of its `raw_files`, and optionally the SHA-1 hash of
+        their (stored) content. The files are read in archive order.
+        '''
+        fingerprint = {}
+        for file_name in self.file_order(test_folder):
+            actual_name, location = self.find(test_folder, file_name)
+            if self.archive is None:
+                stat = os.stat(str(location))
+                entry = [actual_name, stat.st_size, stat.st_mtime_ns]
+            elif self.archive_type == 'zip':
+                entry = [actual_name, location.file_size, list(location.date_time)]
+            else:
+                entry = [actual_name, location.size, location.mtime]
+            if hash_content:
+                sha = hashlib.sha1()
+                actual_name, f = self.open_raw(test_folder, file_name)
+                with f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        sha.update(block)
+                entry.append(sha.hexdigest())
+            fingerprint[file_name] = entry
+        return [fingerprint[file_name] for file_name in raw_files]
@@ -0,0 +1,286 @@
+"""
+Storage of, and access to, the processed data of the test series.
+
+The processed data of a series (per-node results `serieX_all` and per-test
+metrics `serieX_metrics`) is stored in `data_processed/serieX/` either as
+CSV (default) or in a columnar format (Parquet or Feather), with typed
+columns and a parsed timestamp. The columnar formats require `pyarrow`.
+
+The test dates are stored in the columnar formats as UTC timestamps
+(`date_time`) with the UTC offset of the test summaries, in minutes
+(`date_time_offset`), such that the local time of the tests is kept and
+`export_csv` writes back the dates as in the test summaries.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Supported storage formats, with their file extension
+storage_formats = {'csv'     : '.csv',
+                   'parquet' : '.parquet',
+                   'feather' : '.feather'}
+
+# Compact dtypes used in the columnar formats
+series_dtypes = {'test_number'    : 'int32',
+                 'B_n_slots'      : 'int16',
+                 'L_payload_size' : 'int16',
+                 'R_random_seed'  : 'int32',
+                 'H'              : 'int16',
+                 'N'              : 'int16',
+                 'node_id'        : 'int16',
+                 'reason'         : 'int8'}
+
+# Columns identifying a TTnet configuration
+config_columns = ['H', 'N', 'L_payload_size', 'B_n_slots']
+
+# Columns stored as integer codes in a SeriesBuffer
+categorical_columns = ['date_time']
+
+# UTC offset at the end of a date string, e.g. `+02:00`
+utc_offset_regex = r'([+-])(\d{2}):?(\d{2})$'
+
+# ==============================================================================
+def processed_file(out_folder, serie, kind, storage='csv'):
+    '''
+    Path to the processed data file of a series.
+
+    kind:    'all' (per-node results) or 'metrics' (per-test metrics)
+    storage: one of `storage_formats`
+    '''
+    if storage not in storage_formats:
+        raise ValueError('Unknown storage format: %s (expected one of %s)'
+                         % (storage, ', '.join(storage_formats)))
+    return Path(out_folder) / (serie + '_' + kind + storage_formats[storage])
+
+# ==============================================================================
+def parse_date_times(date_times):
+    '''
+    Parse the dates of the test summaries (ISO 8601 strings, e.g.
+    ` 2019-06-02T06:03:01+02:00`) as UTC timestamps.
+
+    Returns the timestamps (DatetimeIndex) and the UTC offsets of the
+    dates, in minutes (int16 array, 0 for dates without an offset).
+    '''
+    # Each distinct date is parsed once
+    codes, uniques = pd.factorize(pd.Series(date_times).astype(str).str.strip())
+    uniques = pd.Series(uniques)
+    offsets = uniques.str.extract(utc_offset_regex)
+    minutes = offsets[1].astype(float)*60 + offsets[2].astype(float)
+    minutes = minutes.where(offsets[0] != '-', -minutes).fillna(0).astype('int16')
+    timestamps = pd.DatetimeIndex(pd.to_datetime(uniques, utc=True))
+    return timestamps.take(codes), minutes.to_numpy()[codes]
+
+def format_date_times(timestamps, offsets):
+    '''
+    Format UTC timestamps with their UTC offsets (minutes), the reverse of
+    `parse_date_times`: returns the dates as written in the test summaries.
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    local = pd.DatetimeIndex(timestamps).tz_convert(None) + pd.to_timedelta(offsets, unit='min')
+    zones = {offset: '%s%02d:%02d' % (('-' if offset < 0 else '+',) + divmod(abs(offset), 60))
+             for offset in np.unique(offsets).tolist()}
+    # The dates follow a `, ` separator in the test summaries
+    return ' ' + local.strftime('%Y-%m-%dT%H:%M:%S') + pd.Index(offsets).map(zones)
+
+# ==============================================================================
+def typed_frame(df):
+    '''
+    Convert a processed DataFrame (indexed by test number) to compact
+    dtypes, with `date_time` parsed as a UTC timestamp and its UTC offset
+    stored in `date_time_offset`.
+    '''
+    df = df.reset_index()
+    for column, dtype in series_dtypes.items():
+        if column in df.columns:
+            df[column] = df[column].astype(dtype)
+    if 'date_time' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['date_time']):
+        timestamps, offsets = parse_date_times(df['date_time'])
+        df['date_time'] = timestamps
+        df.insert(df.columns.get_loc('date_time') + 1, 'date_time_offset', offsets)
+    return df.set_index('test_number')
+
+def csv_frame(df):
+    '''
+    Reverse of `typed_frame`: the dates of a typed DataFrame are formatted
+    back as in the test summaries (and `date_time_offset` dropped).
+    '''
+    if 'date_time_offset' not in df.columns:
+        return df
+    df = df.copy()
+    df['date_time'] = format_date_times(df['date_time'], df['date_time_offset'])
+    return df.drop(columns='date_time_offset')
+
+# ==============================================================================
+def write_processed(df, file_path, storage='csv'):
+    '''
+    Write a processed DataFrame (indexed by test number) to `file_path`.
+    '''
+    if storage == 'csv':
+        df.to_csv(file_path)
+    elif storage == 'parquet':
+        typed_frame(df).reset_index().to_parquet(file_path, index=False)
+    elif storage == 'feather':
+        typed_frame(df).reset_index().to_feather(file_path)
+    else:
+        raise ValueError('Unknown storage format: %s' % storage)
+
+# ==============================================================================
+def read_processed(file_path, storage='csv', columns=None, **kwargs):
+    '''
+    Read a processed DataFrame, indexed by test number.
+
+    columns: optional list of columns to load (besides `test_number`);
+             with the columnar formats, only those columns are read from disk
+             (`date_time` comes with its `date_time_offset`).
+    kwargs:  passed to `pd.read_csv` (csv storage only)
+    '''
+    if columns is not None:
+        columns = ['test_number'] + [c for c in columns if c != 'test_number']
+        if storage != 'csv' and 'date_time' in columns and 'date_time_offset' not in columns:
+            columns.insert(columns.index('date_time') + 1, 'date_time_offset')
+
+    if storage == 'csv':
+        df = pd.read_csv(file_path, usecols=columns, **kwargs)
+        if columns is not None:
+            df = df[columns]
+    elif storage == 'parquet':
+        df = pd.read_parquet(file_path, columns=columns)
+    elif storage == 'feather':
+        df = pd.read_feather(file_path, columns=columns)
+    else:
+        raise ValueError('Unknown storage format: %s' % storage)
+
+    df.set_index('test_number', drop=True, inplace=True)
+    return df
+
+# ==============================================================================
+def export_csv(out_folder, serie, storage, csv_folder=None):
+    '''
+    Export the processed data of a series stored in a columnar format to CSV
+    files (in `csv_folder`, defaults to `out_folder`), as written by
+    `parse_test_series` with the csv storage. The discard table is exported
+    as well, if present.
+    '''
+    if csv_folder is None:
+        csv_folder = out_folder
+    for kind in ['all', 'metrics', 'discards']:
+        file_path = processed_file(out_folder, serie, kind, storage)
+        if kind == 'discards' and not file_path.is_file():
+            continue
+        df = read_processed(file_path, storage)
+        csv_frame(df).to_csv(processed_file(csv_folder, serie, kind, 'csv'))
+
+# ==============================================================================
+def import_csv(out_folder, serie, storage, csv_folder=None):
+    '''
+    Convert the processed data of a series stored as CSV files (in
+    `csv_folder`, defaults to `out_folder`) to a columnar format, the
+    reverse of `export_csv`. The discard table is converted as well, if
+    present.
+    '''
+    if csv_folder is None:
+        csv_folder = out_folder
+    for kind in ['all', 'metrics', 'discards']:
+        csv_file = processed_file(csv_folder, serie, kind, 'csv')
+        if kind == 'discards' and not csv_file.is_file():
+            continue
+        # Exact float parsing, such that the values are converted unchanged
+        df = read_processed(csv_file, 'csv', float_precision='round_trip')
+        write_processed(df, processed_file(out_folder, serie, kind, storage), storage)
+
+# ==============================================================================
+def index_configurations(df):
+    '''
+    Index the rows of a processed DataFrame by TTnet configuration, in a
+    single pass over the data.
+
+    Returns a dictionary mapping (H,N,L,B) tuples to the positional indexes
+    of the corresponding rows (in their original order).
+    '''
+    return df.groupby(config_columns, sort=False).indices
+
+# ==============================================================================
+def configuration_rows(df, config_index, H, N, L, B):
+    '''
+    Rows of `df` with the configuration (H,N,L,B), given the index returned
+    by `index_configurations(df)`. Returns an empty DataFrame if there are none.
+    '''
+    rows = config_index.get((H,N,L,B), np.empty(0, dtype=np.intp))
+    return df.iloc[rows]
+
+# ==============================================================================
+class SeriesBuffer:
+    '''
+    Columnar buffer of the rows of a processed DataFrame, filled while
+    parsing a series.
+
+    Columns are preallocated numpy arrays with the compact `series_dtypes`
+    (float64 by default); the `categorical_columns` store an integer code
+    per row and each distinct value once. The arrays grow by blocks of
+    `block_size` rows, and `to_frame` wraps them without copying.
+    '''
+
+    def __init__(self, labels, block_size=2**16):
+        self.labels     = list(labels)
+        self.block_size = block_size
+        self.n_rows     = 0
+        self.capacity   = 0
+        self.categories = {label: {} for label in self.labels
+                           if label in categorical_columns}
+        self.arrays     = {}
+        for label in self.labels:
+            if label in self.categories:
+                dtype = 'int32'
+            else:
+                dtype = series_dtypes.get(label, 'float64')
+            self.arrays[label] = np.empty(0, dtype=dtype)
+
+    def __len__(self):
+        return self.n_rows
+
+    def reserve(self, n_rows):
+        '''
+        Make room for `n_rows` more rows, growing the arrays by blocks
+        (at least doubling their capacity, for amortized constant-time appends).
+        '''
+        needed = self.n_rows + n_rows
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, 2*self.capacity)
+        capacity = -(-capacity // self.block_size) * self.block_size
+        for label, array in self.arrays.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self.n_rows] = array[:self.n_rows]
+            self.arrays[label] = grown
+        self.capacity = capacity
+
+    def append(self, n_rows, **values):
+        '''
+        Append `n_rows` rows. Each column value is either a scalar (repeated
+        over the rows) or an array of `n_rows` values.
+        '''
+        self.reserve(n_rows)
+        rows = slice(self.n_rows, self.n_rows + n_rows)
+        for label in self.labels:
+            value = values[label]
+            if label in self.categories:
+                codes = self.categories[label]
+                value = codes.setdefault(value, len(codes))
+            self.arrays[label][rows] = value
+        self.n_rows += n_rows
+
+    def to_frame(self, index='test_number'):
+        '''
+        DataFrame of the buffered rows (sharing the buffer memory), indexed
+        by `index`. The categorical columns are returned as pd.Categorical.
+        '''
+        data = {}
+        for label in self.labels:
+            array = self.arrays[label][:self.n_rows]
+            if label in self.categories:
+                array = pd.Categorical.from_codes(array, categories=list(self.categories[label]))
+            data[label] = array
+        df = pd.DataFrame(data, columns=self.labels, copy=False)
+        return df.set_index(index, drop=True)
@@ -0,0 +1,302 @@
+"""
+Synthetic FlockLab raw data, for testing and load-testing the parsing of
+the test series.
+
+Generates `results/<test>/serial.csv` and `testsummary.csv` folders in the
+layout read by `parse_test_series`. Each test runs the TTnet measurement
+sequence on every node:
+
+    - rounds 1-3: bootstrapping (`sched rcv (0 ...)`)
+    - round 4:    measured round with B slots (`[4] E: ...`, `[4] T: ...`)
+    - rounds 5-:  B rounds with one slot (`[r] E: ...`, `[r] T: ...`)
+
+Radio-on times (E) and round lengths (T) are given by the TTnet model (in
+us), with a Gaussian relative noise. Node failures are injected at given
+rates, each one triggering one of the discard rules of the parser:
+
+    - 'bootstrap':    bootstraps in the measured round (`sched rcv (1 ...)`)
+    - 'time_sync':    misses a slot in round 3 (`[3] Missed 1 slots! Binary: 1`)
+    - 'misses':       misses the control packet twice while bootstrapping
+                      (`Schedule missed or corrupted`)
+    - 'first_round':  first measurement printed in the wrong round
+    - 'short_round':  missed the measured round (first T below one slot round)
+    - 'missing_data': stops printing before the end of the test
+
+The generator can also be run as a script, e.g.,
+
+    python -m src.ttnet_synthetic data_raw/serieS --tests 10000 --nodes 100
+"""
+
+import argparse
+import gzip
+import lzma
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.ttnet_model import DPP2_CC430, compute_T_round, compute_T_on_round
+
+# Failure types injected by the generator
+failure_types = ['bootstrap',
+                 'time_sync',
+                 'misses',
+                 'first_round',
+                 'short_round',
+                 'missing_data']
+
+# Failure rates roughly matching the FlockLab series
+default_failure_rates = {'bootstrap'    : 0.01,
+                         'time_sync'    : 0.01,
+                         'misses'       : 0.01,
+                         'first_round'  : 0.005,
+                         'short_round'  : 0.005,
+                         'missing_data' : 0.02}
+
+# Rounds printed before the measured round
+bootstrap_rounds = 3
+
+# ==============================================================================
+def open_output(file_path, compression=None):
+    '''
+    Open a text file for writing, compressed with 'gz', 'xz' or 'zst'
+    (adding the corresponding suffix to `file_path`) or not (None).
+    '''
+    file_path = str(file_path)
+    if compression is None:
+        return open(file_path, 'w')
+    if compression == 'gz':
+        return gzip.open(file_path + '.gz', 'wt', compresslevel=6)
+    if compression == 'xz':
+        return lzma.open(file_path + '.xz', 'wt')
+    if compression == 'zst':
+        import zstandard
+        f = open(file_path + '.zst', 'wb')
+        return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+    raise ValueError('Unknown compression: %s' % compression)
+
+# ==============================================================================
+def draw_failures(n_nodes, failure_rates, rng):
+    '''
+    Draw the failure of each node (None if the node runs correctly); the
+    failures are mutually exclusive.
+    '''
+    if not failure_rates:
+        return [None]*n_nodes
+    unknown = set(failure_rates) - set(failure_types)
+    if unknown:
+        raise ValueError('Unknown failure types: %s' % ', '.join(sorted(unknown)))
+    rates = np.array([failure_rates.get(failure, 0.) for failure in failure_types])
+    if rates.sum() > 1:
+        raise ValueError('The failure rates sum to more than 1.')
+    draws = rng.choice(len(failure_types) + 1, size=n_nodes,
+                       p=np.append(rates, 1 - rates.sum()))
+    return [failure_types[i] if i < len(failure_types) else None for i in draws]
+
+# ==============================================================================
+def node_outputs(failure, B, T_round, T_on_round, T_round_1, T_on_round_1, rng):
+    '''
+    Outputs of one node during a test, as a list of (round, output) pairs.
+    '''
+    outputs = []
+    for round_id in range(1, bootstrap_rounds + 1):
+        outputs.append((round_id, 'sched rcv (0 %d)' % round_id))
+        if failure == 'misses' and round_id > 1:
+            outputs.append((round_id, 'Schedule missed or corrupted'))
+    if failure == 'time_sync':
+        outputs.append((bootstrap_rounds, '[3] Missed 1 slots! Binary: 1'))
+
+    # Measured round (B slots), then B rounds with one slot
+    if failure == 'bootstrap':
+        outputs.append((4, 'sched rcv (1 4)'))
+    measure_round = 5 if failure == 'first_round' else 4
+    outputs.append((4, '[%d] E: %d' % (measure_round, T_on_round[0])))
+    if failure == 'short_round':
+        outputs.append((4, '[4] T: %d' % (T_round_1[0] / 2)))
+    else:
+        outputs.append((4, '[%d] T: %d' % (measure_round, T_round[0])))
+
+    for i in range(B):
+        round_id = 5 + i
+        outputs.append((round_id, '[%d] E: %d' % (round_id, T_on_round_1[i])))
+        outputs.append((round_id, '[%d] T: %d' % (round_id, T_round_1[i])))
+
+    if failure == 'missing_data':
+        # Stop at a random point after the measured round
+        outputs = outputs[:len(outputs) - 1 - rng.integers(0, 2*B)]
+    return outputs
+
+# ==============================================================================
+def generate_test(
+        test_folder,
+        test_number,
+        node_list,
+        B,
+        L,
+        R=0,
+        H=4,
+        N=2,
+        date_time='2020-04-10T10:00:00+02:00',
+        failure_rates=None,
+        noise=0.01,
+        extra_lines=1,
+        compression=None,
+        rng=None,
+        profile=DPP2_CC430):
+    '''
+    Write the raw data of one test in `test_folder`.
+
+    failure_rates: probability of each failure type (see `failure_types`)
+                   for each node; no failures by default.
+    noise:         relative standard deviation of the measured values.
+    extra_lines:   number of additional (non-event) outputs per node and
+                   round, e.g., to match the size of real logs.
+    compression:   compress the files ('gz', 'xz' or 'zst'), or not (None).
+    profile:       model parameters of the simulated platform (see
+                   src.ttnet_model.ModelProfile).
+
+    Returns the list of the failures injected in each node of `node_list`
+    (None for the nodes without failure).
+    '''
+    if rng is None:
+        rng = np.random.default_rng(R)
+    test_folder = Path(test_folder)
+    os.makedirs(str(test_folder), exist_ok=True)
+
+    with open_output(test_folder / "testsummary.csv", compression) as f:
+        f.write('test_number,date_time,B_n_slots,L_payload_size,R_random_seed\n')
+        f.write('%d, %s,%d,%d,%d\n' % (test_number, date_time, B, L, R))
+
+    # Model values (in us), with noise
+    n_nodes = len(node_list)
+    def measure(value, n):
+        return value*1000*(1 + noise*rng.standard_normal((n_nodes, n)))
+    T_round      = measure(compute_T_round(H,N,L,B,profile), 1)
+    T_on_round   = measure(compute_T_on_round(H,N,L,B,profile), 1)
+    T_round_1    = measure(compute_T_round(H,N,L,1,profile), B)
+    T_on_round_1 = measure(compute_T_on_round(H,N,L,1,profile), B)
+
+    # The parser discards measured rounds shorter than a one-slot round
+    # (of the default profile)
+    T_round = np.maximum(T_round, np.ceil(compute_T_round(H,N,L,1)*1000))
+
+    failures = draw_failures(n_nodes, failure_rates, rng)
+
+    # Print times: one round per second, nodes interleaved within a round
+    start = pd.Timestamp(date_time).timestamp()
+    events = []
+    for index, (node_id, failure) in enumerate(zip(node_list, failures)):
+        outputs = node_outputs(failure, B,
+                               T_round[index], T_on_round[index],
+                               T_round_1[index], T_on_round_1[index],
+                               rng)
+        for round_id in range(1, B + 5):
+            for i in range(extra_lines):
+                outputs.append((round_id, '[%d] Slot %d: rcv' % (round_id, i)))
+        offsets = rng.random(len(outputs))
+        for (round_id, output), offset in zip(outputs, offsets):
+            events.append((start + round_id + offset, node_id, output))
+    events.sort()
+
+    with open_output(test_folder / "serial.csv", compression) as f:
+        f.write('# timestamp,observer_id,node_id,direction,output\n')
+        f.writelines(['%.6f,%d,%d,r,%s\n' % (timestamp, node_id, node_id, output)
+                      for timestamp, node_id, output in events])
+
+    return failures
+
+# ==============================================================================
+def generate_series(
+        serie_folder,
+        node_list,
+        n_tests,
+        Bs=[5, 10, 30],
+        Ls=[8, 16, 64],
+        H=4,
+        N=2,
+        failure_rates=None,
+        noise=0.01,
+        extra_lines=1,
+        compression=None,
+        seed=0,
+        first_test=1,
+        start_date='2020-04-10T10:00:00+02:00',
+        test_interval=600,
+        profile=DPP2_CC430):
+    '''
+    Write the raw data of `n_tests` tests in `serie_folder/results` (see
+    `generate_test`), cycling over the (L,B) configurations; the tests
+    are numbered from `first_test`, and run every `test_interval` seconds
+    from `start_date`, with the model parameters `profile`.
+
+    Returns a DataFrame of the injected failures (test_number, node_id, failure).
+    '''
+    rng = np.random.default_rng(seed)
+    configurations = [(L, B) for L in Ls for B in Bs]
+    start = pd.Timestamp(start_date)
+
+    injected = []
+    for i in range(n_tests):
+        test_number = first_test + i
+        L, B = configurations[i % len(configurations)]
+        date_time = (start + pd.Timedelta(seconds=i*test_interval)).isoformat()
+        failures = generate_test(Path(serie_folder) / "results" / str(test_number),
+                                 test_number,
+                                 node_list,
+                                 B,
+                                 L,
+                                 R=int(rng.integers(0, 65536)),
+                                 H=H,
+                                 N=N,
+                                 date_time=date_time,
+                                 failure_rates=failure_rates,
+                                 noise=noise,
+                                 extra_lines=extra_lines,
+                                 compression=compression,
+                                 rng=rng,
+                                 profile=profile)
+        injected.extend((test_number, node_id, failure)
+                        for node_id, failure in zip(node_list, failures)
+                        if failure is not None)
+
+    return pd.DataFrame(injected, columns=['test_number', 'node_id', 'failure'])
+
+# ==============================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic FlockLab raw data.')
+    parser.add_argument('serie_folder',
+                        help='output folder of the series (e.g., data_raw/serieS)')
+    parser.add_argument('--tests', type=int, default=100, help='number of tests')
+    parser.add_argument('--nodes', type=int, default=26, help='number of nodes')
+    parser.add_argument('--Bs', type=int, nargs='+', default=[5, 10, 30],
+                        help='numbers of slots per round')
+    parser.add_argument('--Ls', type=int, nargs='+', default=[8, 16, 64],
+                        help='payload sizes')
+    parser.add_argument('--failures', type=float, default=1.,
+                        help='scaling of the default failure rates (0 for none)')
+    parser.add_argument('--noise', type=float, default=0.01,
+                        help='relative noise of the measured values')
+    parser.add_argument('--extra-lines', type=int, default=1,
+                        help='non-event outputs per node and round')
+    parser.add_argument('--compression', choices=['gz', 'xz', 'zst'], default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failure_rates = {failure: rate*args.failures
+                     for failure, rate in default_failure_rates.items()}
+    injected = generate_series(args.serie_folder,
+                               list(range(1, args.nodes + 1)),
+                               args.tests,
+                               Bs=args.Bs,
+                               Ls=args.Ls,
+                               failure_rates=failure_rates,
+                               noise=args.noise,
+                               extra_lines=args.extra_lines,
+                               compression=args.compression,
+                               seed=args.seed)
+    print('%d tests written in %s (%d node failures injected).'
+          % (args.tests, args.serie_folder, len(injected)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Comparison of the TTnet model with all the measurements of the series.
+
+Joins every measured row of the processed series (`serieX_all.csv`) with
+the corresponding model values, computes the slack of the model and flags
+the violations of the model bounds, then aggregates the tightness of the
+bounds per configuration, per node and per day:
+
+    df = load_measurements([serie_1, serie_2, serie_3], columns=report_columns)
+    report = bound_report(df)
+    report.loc['configuration']
+
+or, as a script, `python -m src.ttnet_validation --output report.csv`.
+
+The model is expected to upper-bound the round length and radio-on time,
+and to lower-bound the energy savings (see `model_bounds`). The slack is
+positive when the bound holds (model above the measurement for an upper
+bound), in us for the times and in percentage points for the energy
+savings. All computations are vectorized over the rows.
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from src.ttnet_model import DPP2_CC430, compute_T_round, compute_T_on_round, compute_energy_saving
+from src.ttnet_calibration import load_measurements
+from src.ttnet_storage import format_date_times
+
+# Measured columns, with the model function and its unit conversion
+model_functions = {'T_round'        : (compute_T_round, 1000),      # ms -> us
+                   'T_on_round'     : (compute_T_on_round, 1000),   # ms -> us
+                   'energy_savings' : (compute_energy_saving, 100)} # ratio -> %
+
+# Type of bound the model should provide for each measured column
+model_bounds = {'T_round'        : 'upper',
+                'T_on_round'     : 'upper',
+                'energy_savings' : 'lower'}
+
+# Columns of the processed series used in the report
+report_columns = ['date_time', 'B_n_slots', 'L_payload_size', 'H', 'N',
+                  'node_id'] + list(model_functions)
+
+# Row groupings of the report
+report_groups = {'configuration' : ['H', 'N', 'L_payload_size', 'B_n_slots'],
+                 'node'          : ['node_id'],
+                 'day'           : ['date_time']}
+
+# ==============================================================================
+def group_codes(columns):
+    '''
+    Index of the distinct tuple of values of `columns` (arrays of
+    non-negative integers) of each row, and the distinct tuples (tuple of
+    arrays, in lexicographic order).
+    '''
+    shape = tuple(int(column.max()) + 1 for column in columns)
+    codes = np.ravel_multi_index(columns, shape)
+    present = np.flatnonzero(np.bincount(codes))
+    index = np.zeros(present[-1] + 1, dtype=np.intp)
+    index[present] = np.arange(len(present))
+    return index[codes], np.unravel_index(present, shape)
+
+def configuration_codes(df):
+    '''
+    Index of the (H,N,L,B) configuration of each row of `df`, and the
+    configurations (tuple of H, N, L and B arrays, by index).
+    '''
+    return group_codes([df[column].to_numpy() for column in report_groups['configuration']])
+
+def test_days(df):
+    '''
+    Index of the day of each row of `df`, and the days (YYYY-MM-DD, local
+    date of the tests, from the dates of the CSV data or from the UTC
+    timestamps and offsets of the columnar formats). The date of each test
+    (`serie`, `test_number`) is parsed once.
+    '''
+    test_number = df['test_number'] if 'test_number' in df else df.index
+    columns = [pd.factorize(np.asarray(test_number))[0]]
+    if 'serie' in df:
+        columns.append(pd.factorize(df['serie'].to_numpy())[0])
+    codes, tests = group_codes(columns)
+    first_rows = np.empty(len(tests[0]), dtype=np.intp)
+    first_rows[codes[::-1]] = np.arange(len(codes))[::-1]
+    dates = df['date_time'].iloc[first_rows]
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        dates = format_date_times(dates, df['date_time_offset'].iloc[first_rows])
+    dates = pd.Index(dates).astype(str).str.strip().str[:10]
+    day_codes, days = pd.factorize(dates, sort=True)
+    return day_codes[codes], np.asarray(days)
+
+# ==============================================================================
+def slack_arrays(df, profile=DPP2_CC430, configurations=None):
+    '''
+    Model value, slack and bound violation of each row of `df`, by column,
+    as arrays. The model is evaluated once per configuration.
+    '''
+    if configurations is None:
+        configurations = configuration_codes(df)
+    codes, (H, N, L, B) = configurations
+
+    result = {}
+    for column, (function, scale) in model_functions.items():
+        model    = (function(H,N,L,B,profile) * scale)[codes]
+        measured = df[column].to_numpy(dtype=float)
+        if model_bounds[column] == 'upper':
+            slack = model - measured
+        else:
+            slack = measured - model
+        result[column] = (model, slack, slack < 0)
+    return result
+
+def model_slack(df, profile=DPP2_CC430):
+    '''
+    Model value, slack and bound violation of each measured row of `df`
+    (processed series data), for each of the `model_functions` columns:
+    `<column>_model`, `<column>_slack` and `<column>_violation`.
+
+    Returns a DataFrame with the same index as `df`.
+    '''
+    result = {}
+    for column, (model, slack, violation) in slack_arrays(df, profile).items():
+        result[column + '_model']     = model
+        result[column + '_slack']     = slack
+        result[column + '_violation'] = violation
+    return pd.DataFrame(result, index=df.index)
+
+def reduce_groups(codes, n_groups, sums, minimums):
+    '''
+    Sum (resp. minimum) of each array of `sums` (resp. `minimums`) over the
+    groups of `codes`, which take values in [0, n_groups). A None array in
+    `sums` counts the elements of each group.
+    '''
+    reduced = {}
+    for name, values in sums.items():
+        reduced[name] = np.bincount(codes, values, n_groups)
+    for name, values in minimums.items():
+        reduced[name] = np.full(n_groups, np.inf)
+        np.minimum.at(reduced[name], codes, values)
+    return reduced
+
+# ==============================================================================
+def bound_report(df, profile=DPP2_CC430, groups=list(report_groups)):
+    '''
+    Tightness of the model bounds over the measured rows of `df` (with the
+    `report_columns`), aggregated per group of rows (see `report_groups`).
+
+    For each measured column, the report gives the fraction of rows
+    violating the bound (`<column>_violations`), the smallest and mean
+    slack (`<column>_min_slack`, `<column>_mean_slack`), and the mean slack
+    relative to the model value (`<column>_relative_slack`; 0 for a tight
+    bound).
+
+    Returns a DataFrame indexed by (group, key), where `key` is the
+    configuration ('H4 N2 L8 B5'), the node id or the day; the 'all' group
+    summarizes all the rows.
+    '''
+    df = df.dropna(subset=list(model_functions))
+    configurations = configuration_codes(df)
+    slack = slack_arrays(df, profile, configurations)
+
+    # Reduce the rows to (configuration, node, day) cells in a single pass;
+    # the groups of the report are then aggregated from the cells
+    configuration_index, (H, N, L, B) = configurations
+    node_index, nodes = pd.factorize(df['node_id'].to_numpy(), sort=True)
+    day_index, days = test_days(df)
+    keys = {'configuration' : ['H%d N%d L%d B%d' % configuration
+                               for configuration in zip(H, N, L, B)],
+            'node'          : np.asarray(nodes).astype(str),
+            'day'           : days}
+    cell_codes, cells = group_codes([configuration_index, node_index, day_index])
+    n_cells = len(cells[0])
+    cell_groups = dict(zip(['configuration', 'node', 'day'], cells))
+
+    sums = {'rows': None}
+    minimums = {}
+    for column, (model, column_slack, violation) in slack.items():
+        sums[column + '_violations']     = violation
+        sums[column + '_mean_slack']     = column_slack
+        sums[column + '_relative_slack'] = column_slack / np.abs(model)
+        minimums[column + '_min_slack']  = column_slack
+    cell_values = reduce_groups(cell_codes, n_cells, sums, minimums)
+
+    tables = []
+    for group in ['all'] + list(groups):
+        if group == 'all':
+            codes, labels = np.zeros(n_cells, dtype=np.intp), np.array(['all'])
+        else:
+            codes, labels = cell_groups[group], np.asarray(keys[group])
+        values = reduce_groups(codes, len(labels),
+                               {name: cell_values[name] for name in sums},
+                               {name: cell_values[name] for name in minimums})
+        rows = values['rows']
+        table = {'rows': rows.astype(np.int64)}
+        for column in slack:
+            table[column + '_violations']     = values[column + '_violations'] / rows
+            table[column + '_min_slack']      = values[column + '_min_slack']
+            table[column + '_mean_slack']     = values[column + '_mean_slack'] / rows
+            table[column + '_relative_slack'] = values[column + '_relative_slack'] / rows
+        table = pd.DataFrame(table, index=pd.MultiIndex.from_arrays([[group]*len(labels), labels],
+                                                                     names=['group', 'key']))
+        tables.append(table)
+    return pd.concat(tables)
+
+# ==============================================================================
+def main():
+    from src.ttnet_analysis import serie_1, serie_2, serie_3
+
+    parser = argparse.ArgumentParser(description='Compare the TTnet model with the measurements.')
+    parser.add_argument('--groups', nargs='+', choices=list(report_groups),
+                        default=list(report_groups), help='row groupings of the report')
+    parser.add_argument('--storage', default='csv',
+                        help='format of the processed data files')
+    parser.add_argument('--output', default=None,
+                        help='CSV file where the report is saved')
+    args = parser.parse_args()
+
+    df = load_measurements([serie_1, serie_2, serie_3], storage=args.storage,
+                           columns=report_columns)
+    report = bound_report(df, groups=args.groups)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None,
+                           'display.width', 200):
+        print(report)
+    if args.output is not None:
+        report.to_csv(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Regression tests of the parsing of the test series, on synthetic raw data
+with injected node failures (see src.ttnet_synthetic).
+
+Run from the repository root with `python -m pytest tests`.
+"""
+
+import contextlib
+import io
+import shutil
+import tarfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.ttnet_analysis import parse_test_series, read_discards, discard_message
+from src.ttnet_logs import Discard
+from src.ttnet_model import compute_T_round
+from src.ttnet_storage import processed_file
+from src.ttnet_synthetic import generate_series, failure_types
+
+serie     = 'serieS'
+node_list = [1, 2, 3, 5, 8, 13, 21, 34]
+n_tests   = 12
+
+# High failure rates, such that every failure type is injected
+failure_rates = {failure: 0.06 for failure in failure_types}
+
+# Discard reason expected for each injected failure
+expected_reasons = {'bootstrap'    : Discard.BOOTSTRAP,
+                    'time_sync'    : Discard.TIME_SYNC,
+                    'misses'       : Discard.MISSES,
+                    'first_round'  : Discard.FIRST_MEASURE,
+                    'short_round'  : Discard.MISSED_MEASURING_ROUND,
+                    'missing_data' : Discard.MISSING_DATA}
+
+# ==============================================================================
+@pytest.fixture(scope='module')
+def raw_series(tmp_path_factory):
+    '''
+    Raw data folder of a synthetic series, and the injected failures.
+    '''
+    raw_data_folder = tmp_path_factory.mktemp('data_raw')
+    injected = generate_series(raw_data_folder / serie, node_list, n_tests,
+                               Bs=[5, 10], Ls=[8, 16],
+                               failure_rates=failure_rates, seed=1)
+    assert set(injected['failure']) == set(failure_types)
+    return raw_data_folder, injected
+
+def parse(raw_data_folder, out_data_folder, **kwargs):
+    '''
+    Parse the synthetic series; returns the per-node and metric DataFrames,
+    the printed output and the error logs (file name -> content).
+    '''
+    logs_folder = raw_data_folder / serie / 'results_error_logs'
+    shutil.rmtree(str(logs_folder), ignore_errors=True)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        df_all, df_metric = parse_test_series({'label': serie, 'node_list': node_list},
+                                              raw_data_folder,
+                                              out_data_folder,
+                                              force_computation=True,
+                                              plot=False,
+                                              verbose=True,
+                                              **kwargs)
+    error_logs = {f.name: f.read_bytes() for f in logs_folder.iterdir()}
+    return df_all, df_metric, output.getvalue(), error_logs
+
+def read_outputs(out_data_folder):
+    '''
+    Content of the processed data files of the series.
+    '''
+    return {kind: processed_file(out_data_folder / serie, serie, kind).read_bytes()
+            for kind in ['all', 'metrics', 'discards']}
+
+@pytest.fixture(scope='module')
+def serial_run(raw_series, tmp_path_factory):
+    '''
+    Results and processed data files of the serial parsing of the series.
+    '''
+    raw_data_folder, injected = raw_series
+    out_data_folder = tmp_path_factory.mktemp('data_processed')
+    return parse(raw_data_folder, out_data_folder), read_outputs(out_data_folder)
+
+# ==============================================================================
+def test_discard_reasons(raw_series, serial_run, tmp_path):
+    raw_data_folder, injected = raw_series
+    (df_all, df_metric, output, error_logs), outputs = serial_run
+
+    expected = injected.assign(reason=[expected_reasons[failure] for failure in injected['failure']])
+    expected = expected.sort_values(['test_number', 'node_id'])
+
+    processed = tmp_path / serie
+    processed.mkdir()
+    processed_file(processed, serie, 'discards').write_bytes(outputs['discards'])
+    discards = read_discards({'label': serie}, tmp_path).reset_index()
+    discards = discards.sort_values(['test_number', 'node_id'])
+
+    assert discards['test_number'].tolist() == expected['test_number'].tolist()
+    assert discards['node_id'].tolist() == expected['node_id'].tolist()
+    assert discards['reason'].tolist() == [Discard(reason).name for reason in expected['reason']]
+
+    # One verbose message per discarded node
+    for test_nb, node_id, reason in zip(expected['test_number'], expected['node_id'],
+                                        expected['reason']):
+        assert discard_message(test_nb, node_id, reason) in output
+
+def test_parsed_values(raw_series, serial_run):
+    raw_data_folder, injected = raw_series
+    (df_all, df_metric, output, error_logs), outputs = serial_run
+
+    assert len(df_all) == n_tests * len(node_list)
+    assert len(df_metric) == n_tests
+
+    discarded = set(zip(injected['test_number'], injected['node_id']))
+    is_discarded = np.array([(test_nb, node_id) in discarded
+                             for test_nb, node_id in zip(df_all.index, df_all['node_id'])])
+    values = df_all[['T_round', 'T_round_1slot', 'T_on_round',
+                     'T_on_without_round', 'energy_savings']]
+    assert values[is_discarded].isna().all().all()
+    assert values[~is_discarded].notna().all().all()
+
+    # Measured values within the noise of the model
+    kept = df_all[~is_discarded]
+    model = compute_T_round(kept['H'], kept['N'], kept['L_payload_size'], kept['B_n_slots'])
+    np.testing.assert_allclose(kept['T_round'], model*1000, rtol=0.05)
+    np.testing.assert_allclose(kept['energy_savings'],
+                               100*(kept['T_on_without_round'] - kept['T_on_round'])
+                               / kept['T_on_without_round'])
+
+    # Test metrics: longest round and median energy savings over the nodes
+    grouped = df_all.groupby(level='test_number')
+    np.testing.assert_allclose(df_metric['T_round'], grouped['T_round'].max().loc[df_metric.index])
+    np.testing.assert_allclose(df_metric['energy_savings'],
+                               grouped['energy_savings'].median().loc[df_metric.index])
+
+def test_error_logs(raw_series, serial_run):
+    raw_data_folder, injected = raw_series
+    (df_all, df_metric, output, error_logs), outputs = serial_run
+
+    # Logs of the nodes missing some data: all the discarded nodes but those
+    # that missed the measured round
+    failed = injected[injected['failure'] != 'short_round']
+    expected_names = {'%d_%d' % (test_nb, node_id)
+                      for test_nb, node_id in zip(failed['test_number'], failed['node_id'])}
+    assert set(error_logs) == expected_names
+
+    for test_folder in (raw_data_folder / serie / 'results').iterdir():
+        test_nb = int(test_folder.name)
+        lines = (test_folder / 'serial.csv').read_bytes().splitlines(keepends=True)
+        for name in error_logs:
+            if name.startswith('%d_' % test_nb):
+                node_id = name.split('_')[1].encode()
+                expected = b''.join(line for line in lines
+                                    if not line.startswith(b'#')
+                                    and line.split(b',')[2] == node_id)
+                assert error_logs[name] == expected
+
+def test_parallel_parsing(raw_series, serial_run, tmp_path):
+    raw_data_folder, injected = raw_series
+    (df_all, df_metric, output, error_logs), outputs = serial_run
+
+    result = parse(raw_data_folder, tmp_path, workers=2, chunksize=2)
+    assert result[2] == output
+    assert result[3] == error_logs
+    assert read_outputs(tmp_path) == outputs
+    pd.testing.assert_frame_equal(result[0], df_all)
+    pd.testing.assert_frame_equal(result[1], df_metric)
+
+def test_archive_parsing(raw_series, serial_run, tmp_path):
+    raw_data_folder, injected = raw_series
+    (df_all, df_metric, output, error_logs), outputs = serial_run
+
+    # Same raw data in a compressed archive, with the tests and their files
+    # stored in reverse order
+    archive_folder = tmp_path / 'data_raw'
+    (archive_folder / serie).mkdir(parents=True)
+    with tarfile.open(str(archive_folder / serie / 'results.tar.gz'), 'w:gz') as archive:
+        for test_folder in sorted((raw_data_folder / serie / 'results').iterdir(), reverse=True):
+            for file_name in ['serial.csv', 'testsummary.csv']:
+                archive.add(str(test_folder / file_name),
+                            arcname='results/%s/%s' % (test_folder.name, file_name))
+
+    out_data_folder = tmp_path / 'data_processed'
+    result = parse(archive_folder, out_data_folder)
+    assert result[2] == output
+    assert result[3] == error_logs
+    assert read_outputs(out_data_folder) == outputs